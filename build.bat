@@ -16,7 +16,7 @@ echo.
 echo 3. Instalando as dependências pelo pip...
 .\venv\Scripts\pip install --disable-pip-version-check mypy && ^
 .\venv\Scripts\pip install --disable-pip-version-check flask && ^
-.\venv\Scripts\pip install --disable-pip-version-check weasyprint && ^
+.\venv\Scripts\pip install --disable-pip-version-check "weasyprint>=68" && ^
 .\venv\Scripts\pip install --disable-pip-version-check selenium && ^
 goto parte4
 goto fim
@@ -0,0 +1 @@
+.\venv\Scripts\python -m livros daemon_livros %*
\ No newline at end of file
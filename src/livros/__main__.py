@@ -1,2 +1,4 @@
 from livros.cli import Cli
-Cli().run()
\ No newline at end of file
+# A proteção é necessária porque os processos de renderização reimportam este módulo.
+if __name__ == "__main__":
+    Cli().run()
\ No newline at end of file
@@ -0,0 +1,123 @@
+import livros
+from typing import Callable
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+import math, time, traceback
+
+pacotes_simultaneos = 2
+tamanho_fila = 32
+fila_por_cliente = 4
+duracao_estimada = 60.0
+
+class FilaCheia(Exception):
+
+    def __init__(self, mensagem: str, por_cliente: bool, retry_after: int) -> None:
+        super().__init__(mensagem)
+        self.__por_cliente = por_cliente
+        self.__retry_after = retry_after
+
+    @property
+    def por_cliente(self) -> bool:
+        return self.__por_cliente
+
+    @property
+    def retry_after(self) -> int:
+        return self.__retry_after
+
+# Executa as tarefas com um número fixo de threads. Cada cliente tem a sua própria fila e as threads
+# atendem os clientes em rodízio, de forma que um cliente que envia muitos pacotes não atrasa os demais.
+class Agendador:
+
+    def __init__(self, trabalhadores: int = pacotes_simultaneos, tamanho: int = tamanho_fila, por_cliente: int = fila_por_cliente) -> None:
+        if trabalhadores < 1: raise Exception(f"O número de pacotes simultâneos deve ser positivo, mas foi {trabalhadores}.")
+        if tamanho < 1: raise Exception(f"O tamanho da fila deve ser positivo, mas foi {tamanho}.")
+        self.__trabalhadores = trabalhadores
+        self.__tamanho = tamanho
+        self.__por_cliente = por_cliente
+        self.__condicao = Condition()
+        self.__filas: OrderedDict[str, deque[tuple[str, Callable[[], None]]]] = OrderedDict() # Mutável, guardado pela condição.
+        self.__pendentes = 0                                                                  # Mutável, guardado pela condição.
+        self.__executando: set[str] = set()                                                   # Mutável, guardado pela condição.
+        self.__duracao_media: float | None = None                                             # Mutável, guardado pela condição.
+        self.__iniciado = False                                                               # Mutável, guardado pela condição.
+
+    def verificar(self, cliente: str) -> None:
+        with self.__condicao:
+            if self.__pendentes >= self.__tamanho:
+                raise FilaCheia("A fila de pacotes está cheia. Tente novamente mais tarde.", False, self.__estimativa())
+            fila = self.__filas.get(cliente)
+            if fila is not None and len(fila) >= self.__por_cliente:
+                raise FilaCheia(f"Você já tem {len(fila)} pacotes na fila. Aguarde algum deles terminar.", True, self.__estimativa())
+
+    def submeter(self, cliente: str, nome: str, tarefa: Callable[[], None]) -> None:
+        with self.__condicao:
+            self.verificar(cliente)
+            if cliente not in self.__filas: self.__filas[cliente] = deque()
+            self.__filas[cliente].append((nome, tarefa))
+            self.__pendentes += 1
+            self.__iniciar()
+            self.__condicao.notify()
+
+    # Simula o rodízio para descobrir em que posição (a partir de 1) o pacote será atendido.
+    def posicao(self, nome: str) -> int | None:
+        with self.__condicao:
+            posicao = 0
+            filas = list(self.__filas.values())
+            for rodada in range(max((len(f) for f in filas), default = 0)):
+                for fila in filas:
+                    if rodada >= len(fila): continue
+                    posicao += 1
+                    if fila[rodada][0] == nome: return posicao
+            return None
+
+    @property
+    def estatisticas(self) -> dict[str, int]:
+        with self.__condicao:
+            return {
+                "pendentes": self.__pendentes,
+                "executando": len(self.__executando),
+                "trabalhadores": self.__trabalhadores,
+                "tamanho_fila": self.__tamanho,
+            }
+
+    # Deve ser chamado com a condição obtida.
+    def __estimativa(self) -> int:
+        media = duracao_estimada if self.__duracao_media is None else self.__duracao_media
+        return max(1, math.ceil(media * math.ceil((self.__pendentes + 1) / self.__trabalhadores)))
+
+    # Deve ser chamado com a condição obtida.
+    def __iniciar(self) -> None:
+        if self.__iniciado: return
+        self.__iniciado = True
+        for i in range(self.__trabalhadores):
+            t = Thread(target = self.__trabalhar, args = (), name = f"agendador-{i + 1}")
+            t.daemon = True
+            t.start()
+
+    # Deve ser chamado com a condição obtida. O cliente atendido vai para o fim do rodízio.
+    def __proximo(self) -> tuple[str, Callable[[], None]]:
+        cliente, fila = next(iter(self.__filas.items()))
+        del self.__filas[cliente]
+        item = fila.popleft()
+        if fila: self.__filas[cliente] = fila
+        self.__pendentes -= 1
+        return item
+
+    def __trabalhar(self) -> None:
+        while True:
+            with self.__condicao:
+                while self.__pendentes == 0:
+                    self.__condicao.wait()
+                nome, tarefa = self.__proximo()
+                self.__executando.add(nome)
+            inicio = time.monotonic()
+            try:
+                tarefa()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                duracao = time.monotonic() - inicio
+                with self.__condicao:
+                    self.__executando.discard(nome)
+                    m = self.__duracao_media
+                    self.__duracao_media = duracao if m is None else 0.8 * m + 0.2 * duracao
\ No newline at end of file
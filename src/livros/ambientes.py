@@ -0,0 +1,71 @@
+import livros
+from livros.cache import normalizar
+from collections import OrderedDict
+from threading import RLock
+import jinja2, jinja2.meta, hashlib, os
+
+pasta_bytecode = "cache/jinja"
+limite_ambientes = 16
+
+# O FileSystemBytecodeCache padrão usa o nome do arquivo como chave. Como cada pacote enviado é extraído
+# para uma pasta temporária diferente, isso faria o cache crescer sem reaproveitar nada. Aqui a chave é
+# o nome do template junto com o seu conteúdo, e assim templates idênticos compartilham o mesmo bytecode.
+class BytecodePorConteudo(jinja2.FileSystemBytecodeCache):
+
+    def get_bucket(self, environment: jinja2.Environment, name: str, filename: str | None, source: str) -> jinja2.bccache.Bucket:
+        key = hashlib.sha256(f"{name}\0{source}".encode("utf-8")).hexdigest()
+        bucket = jinja2.bccache.Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+# Um ambiente por pasta de pacote, para que layouts e macros compartilhados sejam compilados só uma vez
+# por pacote. O loader dos plugins e o cache de bytecode são compartilhados por todos os ambientes.
+class AmbientesJinja:
+
+    def __init__(self) -> None:
+        os.makedirs(pasta_bytecode, exist_ok = True)
+        self.__plugins = jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__), "plugins"))
+        self.__bytecode = BytecodePorConteudo(os.path.abspath(pasta_bytecode))
+        self.__lock = RLock()
+        self.__ambientes: OrderedDict[str, jinja2.Environment] = OrderedDict() # Mutável, guardado pelo lock.
+
+    def obter(self, src_dir: str) -> jinja2.Environment:
+        with self.__lock:
+            ambiente = self.__ambientes.get(src_dir)
+            if ambiente is not None:
+                self.__ambientes.move_to_end(src_dir)
+                return ambiente
+            loader = jinja2.ChoiceLoader([jinja2.FileSystemLoader(src_dir), self.__plugins])
+            ambiente = jinja2.Environment(loader = loader, bytecode_cache = self.__bytecode, auto_reload = True)
+            self.__ambientes[src_dir] = ambiente
+            while len(self.__ambientes) > limite_ambientes:
+                self.__ambientes.popitem(last = False)
+            return ambiente
+
+ambientes = AmbientesJinja()
+
+def ambiente_jinja(src_dir: str) -> jinja2.Environment:
+    return ambientes.obter(src_dir)
+
+# Os arquivos dos templates usados por um template, incluindo ele mesmo, seguindo extends, include e import.
+# Devolve None se algum deles referencia um template por um nome calculado, que não dá para saber sem renderizar.
+def dependencias_jinja(src_dir: str, nome: str) -> set[str] | None:
+    ambiente = ambiente_jinja(src_dir)
+    if ambiente.loader is None: return None
+    arquivos: set[str] = set()
+    vistos: set[str] = set()
+    pendentes = [nome]
+    while pendentes:
+        atual = pendentes.pop()
+        if atual in vistos: continue
+        vistos.add(atual)
+        try:
+            fonte, arquivo, _ = ambiente.loader.get_source(ambiente, atual)
+        except jinja2.TemplateNotFound:
+            arquivos.add(normalizar(os.path.join(src_dir, atual)))
+            continue
+        if arquivo is not None: arquivos.add(normalizar(arquivo))
+        for referencia in jinja2.meta.find_referenced_templates(ambiente.parse(fonte)):
+            if referencia is None: return None
+            pendentes.append(referencia)
+    return arquivos
\ No newline at end of file
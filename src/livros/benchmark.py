@@ -0,0 +1,189 @@
+import livros
+from livros.model import Biblioteca, Dir, File
+from typing import TYPE_CHECKING, cast
+from glob import glob
+from urllib.parse import unquote
+import argparse, os, shutil, struct, sys, tempfile, time, zlib
+
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+paragrafos_por_pagina = 6
+
+lorem = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo "
+    "consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur."
+)
+
+codigo = """<pre><code class="language-python">def fibonacci(n: int) -&gt; int:
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+</code></pre>"""
+
+matematica = "<p>Seja $[ f(x) = \\sum_{i=0}^{n} \\frac{x^i}{i!} ]$, então $[ \\lim_{n \\to \\infty} f(x) = e^x ]$.</p>"
+
+# Faz o papel do Selenium sem abrir navegador nenhum: devolve o HTML da página exatamente como foi carregado,
+# sem rodar JavaScript. Serve para medir o restante do processo numa máquina sem Firefox e sem tela.
+class DriverFalso:
+
+    def __init__(self) -> None:
+        self.__html = ""
+
+    def get(self, url: str) -> None:
+        if not url.startswith("file:///"):
+            self.__html = "<html></html>"
+            return
+        with open(unquote(url[len("file:///"):]), "r", encoding = "utf-8") as f:
+            self.__html = f.read()
+
+    def execute_script(self, script: str, *args: object) -> object:
+        return 1
+
+    def find_element(self, by: str, value: str) -> "DriverFalso":
+        return self
+
+    def get_attribute(self, name: str) -> str:
+        return self.__html
+
+    def delete_all_cookies(self) -> None:
+        pass
+
+    def quit(self) -> None:
+        pass
+
+def abrir_driver_falso() -> "WebDriver":
+    return cast("WebDriver", DriverFalso())
+
+# PNG RGB de uma cor só, sem depender de nenhuma biblioteca de imagens.
+def gerar_png(largura: int, altura: int, cor: tuple[int, int, int]) -> bytes:
+    def bloco(tipo: bytes, dados: bytes) -> bytes:
+        return struct.pack(">I", len(dados)) + tipo + dados + struct.pack(">I", zlib.crc32(tipo + dados) & 0xFFFFFFFF)
+    linha = b"\0" + bytes(cor) * largura
+    cabecalho = struct.pack(">IIBBBBB", largura, altura, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + bloco(b"IHDR", cabecalho) + bloco(b"IDAT", zlib.compress(linha * altura)) + bloco(b"IEND", b"")
+
+def fontes_do_sistema() -> list[str]:
+    padroes = ["/usr/share/fonts/**/*.ttf", "/usr/local/share/fonts/**/*.ttf", "C:/Windows/Fonts/*.ttf", "/Library/Fonts/*.ttf"]
+    encontradas: list[str] = []
+    for p in padroes:
+        encontradas += glob(p, recursive = True)
+    return sorted(encontradas)
+
+def gerar_pacote(pasta: str, capitulos: int, paginas: int, imagens: int, fontes: int, densidade_codigo: float, densidade_matematica: float, plugins: bool) -> None:
+    os.makedirs(os.path.join(pasta, "img"), exist_ok = True)
+    os.makedirs(os.path.join(pasta, "fontes"), exist_ok = True)
+    os.makedirs(os.path.join(pasta, "modelos"), exist_ok = True)
+
+    for i in range(imagens):
+        with open(os.path.join(pasta, "img", f"imagem-{i}.png"), "wb") as f:
+            f.write(gerar_png(800 + 16 * i, 600, ((37 * i) % 256, (91 * i) % 256, (151 * i) % 256)))
+
+    css = []
+    disponiveis = fontes_do_sistema()
+    if fontes > 0 and not disponiveis:
+        print("Nenhuma fonte TTF encontrada no sistema. O pacote será gerado sem fontes.", file = sys.stderr)
+    for i in range(fontes if disponiveis else 0):
+        shutil.copyfile(disponiveis[i % len(disponiveis)], os.path.join(pasta, "fontes", f"fonte-{i}.ttf"))
+        css.append(f'@font-face {{ font-family: "Fonte{i}"; src: url("fontes/fonte-{i}.ttf"); }}')
+        css.append(f".fonte-{i} {{ font-family: \"Fonte{i}\"; }}")
+    css.append("img { width: 8cm; }")
+    css.append("pre { background: #eee; padding: 4px; }")
+    with open(os.path.join(pasta, "estilo.css"), "w", encoding = "utf-8") as f:
+        f.write("\n".join(css))
+
+    extras = ""
+    if plugins:
+        extras = '{% include "plugins/highlight.html" %}\n{% include "plugins/mathjax.html" %}\n'
+    with open(os.path.join(pasta, "modelos", "layout.html"), "w", encoding = "utf-8") as f:
+        f.write(
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<link rel="stylesheet" href="{{ dir_path }}/estilo.css">\n' + extras +
+            "</head>\n<body>\n{% block conteudo %}{% endblock %}\n</body>\n</html>"
+        )
+
+    for c in range(capitulos):
+        corpo = [f"<h1>Capítulo {c + 1}</h1>"]
+        for p in range(paginas):
+            n = c * paginas + p
+            classe = f' class="fonte-{n % fontes}"' if fontes > 0 and disponiveis else ""
+            corpo.append(f"<h2>Seção {c + 1}.{p + 1}</h2>")
+            corpo += [f"<p{classe}>{lorem}</p>" for _ in range(paragrafos_por_pagina)]
+            if imagens > 0: corpo.append(f'<img src="{{{{ dir_path }}}}/img/imagem-{n % imagens}.png">')
+            if int((n + 1) * densidade_codigo) > int(n * densidade_codigo): corpo.append(codigo)
+            if int((n + 1) * densidade_matematica) > int(n * densidade_matematica): corpo.append(matematica)
+        with open(os.path.join(pasta, f"capitulo-{c + 1:03}.html"), "w", encoding = "utf-8") as f:
+            f.write('{% extends "modelos/layout.html" %}\n{% block conteudo %}\n' + "\n".join(corpo) + "\n{% endblock %}")
+
+# Pico de memória residente em MB deste processo e dos processos de renderização já encerrados.
+def pico_rss() -> tuple[float, float] | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    escala = 1024 * 1024 if sys.platform == "darwin" else 1024
+    proprio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / escala
+    filhos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / escala
+    return proprio, filhos
+
+def relatorio(rodada: int, duracao: float, resumo: dict[str, object]) -> None:
+    etapas = cast(dict[str, dict[str, float]], resumo["etapas"])
+    livros_ = cast(int, resumo["livros"])
+    paginas = cast(int, resumo["paginas"])
+    print(f"\nRodada {rodada}: {duracao:.2f} s, {livros_} livros, {paginas} páginas, {cast(int, resumo['bytes']) / 1024 / 1024:.1f} MB de PDF.")
+    print(f"  {livros_ / duracao:.2f} livros/s, {paginas / duracao:.2f} páginas/s")
+    print(f"  {'etapa':<20}{'total (s)':>12}{'vezes':>8}{'média (ms)':>14}{'por s':>10}")
+    for etapa, v in sorted(etapas.items(), key = lambda x: -x[1]["segundos"]):
+        segundos, vezes = v["segundos"], v["vezes"]
+        media = 1000 * segundos / vezes if vezes else 0
+        taxa = vezes / segundos if segundos else float("inf")
+        print(f"  {etapa:<20}{segundos:>12.3f}{int(vezes):>8}{media:>14.1f}{taxa:>10.1f}")
+    rss = pico_rss()
+    if rss is not None:
+        print(f"  Pico de RSS: {rss[0]:.1f} MB (processo principal), {rss[1]:.1f} MB (processos filhos)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog = "python -m livros.benchmark", description = "Mede a montagem de pacotes sintéticos de livros.")
+    parser.add_argument("--capitulos", type = int, default = 10)
+    parser.add_argument("--paginas", type = int, default = 5, help = "seções de aproximadamente uma página por capítulo")
+    parser.add_argument("--imagens", type = int, default = 5)
+    parser.add_argument("--fontes", type = int, default = 2)
+    parser.add_argument("--codigo", type = float, default = 0.5, help = "fração das seções com um bloco de código")
+    parser.add_argument("--matematica", type = float, default = 0.5, help = "fração das seções com fórmulas")
+    parser.add_argument("--plugins", action = "store_true", help = "inclui os plugins de highlight e MathJax (acessam a internet)")
+    parser.add_argument("--rodadas", type = int, default = 1)
+    parser.add_argument("--trabalhadores", type = int, default = 1)
+    parser.add_argument("--navegadores", type = int, default = 1)
+    parser.add_argument("--cache", action = "store_true", help = "usa o cache de PDFs, de forma que da segunda rodada em diante há acertos")
+    parser.add_argument("--firefox", action = "store_true", help = "usa o Firefox de verdade em vez do navegador falso")
+    parser.add_argument("--motor", choices = livros.motor.motores, default = livros.motor.motor_padrao)
+    parser.add_argument("--verboso", action = "store_true")
+    args = parser.parse_args()
+
+    os.makedirs("temp", exist_ok = True)
+    pasta = tempfile.mkdtemp(prefix = "livros-benchmark-")
+    try:
+        print(f"Gerando o pacote sintético em {pasta}...")
+        src = os.path.join(pasta, "pacote")
+        gerar_pacote(src, args.capitulos, args.paginas, args.imagens, args.fontes, args.codigo, args.matematica, args.plugins)
+        notify = print if args.verboso else (lambda x: None)
+        abrir = livros.navegador.abrir_firefox if args.firefox else abrir_driver_falso
+        limite_cache = livros.cache.limite_cache if args.cache else 0
+        biblioteca = Biblioteca(notify, False, args.navegadores, args.trabalhadores, limite_cache, abrir_navegador = abrir, motor = args.motor)
+        try:
+            for rodada in range(1, args.rodadas + 1):
+                inicio = time.monotonic()
+                p = biblioteca.criar_pacote_dir(Dir(src), File(os.path.join(pasta, f"saida-{rodada}.zip")))
+                p.assemble()
+                relatorio(rodada, time.monotonic() - inicio, p.tempos.resumo)
+            cache = biblioteca.recursos.cache
+            if cache is not None: print(f"\nCache: {cache.estatisticas}")
+        finally:
+            biblioteca.encerrar()
+    finally:
+        shutil.rmtree(pasta, ignore_errors = True)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,214 @@
+import livros
+from collections import OrderedDict
+from threading import RLock
+from urllib.parse import unquote, urlsplit
+from urllib.request import url2pathname
+import hashlib, os, re, shutil, uuid
+
+pasta_cache = "cache"
+limite_cache = 1024 * 1024 * 1024
+
+referencia_html = re.compile(r"""(?:src|href)\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+referencia_css = re.compile(r"""url\(\s*["']?([^"')]+)["']?\s*\)|@import\s+["']([^"']+)["']""", re.IGNORECASE)
+
+# Cada pacote é extraído para uma pasta temporária diferente, cuja URL aparece no HTML renderizado.
+# Ela é trocada por este marcador para que pacotes iguais em pastas diferentes compartilhem o cache.
+marcador_src = "\0livros-src\0"
+
+# Segue as referências do HTML e, recursivamente, as dos CSS referenciados. Só entram arquivos locais, existentes ou não.
+def dependencias(html_content: str, src_dir: str) -> set[str]:
+    vistos: set[str] = set()
+    pendentes = [(ref, src_dir) for ref in referencia_html.findall(html_content)]
+    pendentes += [(a or b, src_dir) for a, b in referencia_css.findall(html_content)]
+    while pendentes:
+        ref, base = pendentes.pop()
+        caminho = resolver_referencia(ref, base)
+        if caminho is None or caminho in vistos: continue
+        vistos.add(caminho)
+        if caminho.lower().endswith(".css") and os.path.isfile(caminho):
+            with open(caminho, "r", encoding = "utf-8", errors = "replace") as f:
+                pendentes += [(a or b, os.path.dirname(caminho)) for a, b in referencia_css.findall(f.read())]
+    return vistos
+
+def resolver_referencia(ref: str, base: str) -> str | None:
+    partes = urlsplit(ref.strip())
+    if partes.scheme == "file": return normalizar(url2pathname(partes.path))
+    if partes.scheme != "" or partes.netloc != "" or partes.path == "": return None
+    return normalizar(os.path.join(base, unquote(partes.path)))
+
+# Os caminhos das dependências são comparados com os da pasta observada pelo --watch, então os dois lados precisam
+# estar na mesma forma. No POSIX, o abspath mantém as duas barras de um caminho que começa com //.
+def normalizar(caminho: str) -> str:
+    n = os.path.normcase(os.path.abspath(caminho))
+    if os.name != "nt" and n.startswith("//"): n = "/" + n.lstrip("/")
+    return n
+
+# Os caminhos fora de src_dir continuam absolutos.
+def relativo(caminho: str, src_dir: str) -> str:
+    base = os.path.abspath(src_dir)
+    try:
+        if os.path.commonpath([caminho, base]) != base: return caminho
+    except ValueError:
+        return caminho
+    return marcador_src + os.path.relpath(caminho, base).replace(os.sep, "/")
+
+class CacheLivros:
+
+    def __init__(self, pasta: str = pasta_cache, limite: int = limite_cache) -> None:
+        if limite <= 0: raise Exception(f"O limite do cache deve ser positivo, mas foi {limite}.")
+        self.__pasta = os.path.abspath(pasta)
+        self.__limite = limite
+        self.__lock = RLock()
+        self.__entradas: OrderedDict[str, int] = OrderedDict() # Mutável, guardado pelo lock. Do menos para o mais recente.
+        self.__total = 0                                       # Mutável, guardado pelo lock.
+        self.__hashes: dict[str, tuple[int, int, str]] = {}   # Mutável, guardado pelo lock.
+        self.__acertos_pdf = 0                                 # Mutável, guardado pelo lock.
+        self.__acertos_html = 0                                # Mutável, guardado pelo lock.
+        self.__faltas = 0                                      # Mutável, guardado pelo lock.
+        os.makedirs(self.__pasta, exist_ok = True)
+        self.__carregar()
+
+    def __carregar(self) -> None:
+        existentes = []
+        for nome in os.listdir(self.__pasta):
+            caminho = os.path.join(self.__pasta, nome)
+            if nome.endswith(".tmp"):
+                os.remove(caminho)
+            elif os.path.isfile(caminho):
+                st = os.stat(caminho)
+                existentes.append((st.st_mtime_ns, nome, st.st_size))
+        for _, nome, tamanho in sorted(existentes):
+            self.__entradas[nome] = tamanho
+            self.__total += tamanho
+        self.__evict()
+
+    # A variante separa resultados diferentes obtidos a partir do mesmo HTML, como os de cada motor.
+    # As dependências dentro de src_dir entram pelo caminho relativo, para que a chave não mude de um envio para outro.
+    def chave(self, html_content: str, src_dir: str, src_url: str, variante: str = "") -> str:
+        h = hashlib.sha256(html_content.replace(src_url, marcador_src).encode("utf-8"))
+        if variante: h.update(b"\0" + variante.encode("utf-8"))
+        for caminho in sorted(c for c in dependencias(html_content, src_dir) if os.path.isfile(c)):
+            h.update(b"\0" + relativo(caminho, src_dir).encode("utf-8") + b"\0" + self.__hash_arquivo(caminho).encode("ascii"))
+        return h.hexdigest()
+
+    def __hash_arquivo(self, caminho: str) -> str:
+        st = os.stat(caminho)
+        with self.__lock:
+            memo = self.__hashes.get(caminho)
+            if memo is not None and memo[0] == st.st_mtime_ns and memo[1] == st.st_size: return memo[2]
+        h = hashlib.sha256()
+        with open(caminho, "rb") as f:
+            for bloco in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(bloco)
+        digest = h.hexdigest()
+        with self.__lock:
+            self.__hashes[caminho] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def obter_pdf(self, chave: str, destino: str) -> bool:
+        if not self.__copiar(f"{chave}.pdf", destino): return False
+        with self.__lock:
+            self.__acertos_pdf += 1
+        return True
+
+    def obter_html(self, chave: str, src_url: str) -> str | None:
+        nome = f"{chave}.html"
+        with self.__lock:
+            if nome not in self.__entradas:
+                self.__faltas += 1
+                return None
+            self.__tocar(nome)
+            try:
+                with open(os.path.join(self.__pasta, nome), "r", encoding = "utf-8") as f:
+                    conteudo = f.read()
+            except OSError:
+                self.__remover(nome)
+                self.__faltas += 1
+                return None
+            self.__acertos_html += 1
+            return conteudo.replace(marcador_src, src_url)
+
+    def guardar_html(self, chave: str, html_content: str, src_url: str) -> None:
+        temp = self.__temp()
+        with open(temp, "w", encoding = "utf-8") as f:
+            f.write(html_content.replace(src_url, marcador_src))
+        self.__publicar(temp, f"{chave}.html")
+
+    def guardar_pdf(self, chave: str, origem: str) -> None:
+        self.guardar_arquivo(f"{chave}.pdf", origem)
+
+    # Para outros usos do cache, como as imagens otimizadas. O nome deve incluir o hash do conteúdo que o originou.
+    def obter_arquivo(self, nome: str, destino: str) -> bool:
+        return self.__copiar(nome, destino)
+
+    def guardar_arquivo(self, nome: str, origem: str) -> None:
+        temp = self.__temp()
+        shutil.copyfile(origem, temp)
+        self.__publicar(temp, nome)
+
+    # Uma entrada vazia, que só serve para ser encontrada por existe.
+    def marcar(self, nome: str) -> None:
+        temp = self.__temp()
+        open(temp, "wb").close()
+        self.__publicar(temp, nome)
+
+    def existe(self, nome: str) -> bool:
+        with self.__lock:
+            if nome not in self.__entradas: return False
+            self.__tocar(nome)
+            return True
+
+    def __temp(self) -> str:
+        return os.path.join(self.__pasta, f"{uuid.uuid4()}.tmp")
+
+    def __copiar(self, nome: str, destino: str) -> bool:
+        with self.__lock:
+            if nome not in self.__entradas: return False
+            self.__tocar(nome)
+            try:
+                shutil.copyfile(os.path.join(self.__pasta, nome), destino)
+                return True
+            except OSError:
+                self.__remover(nome)
+                return False
+
+    def __publicar(self, temp: str, nome: str) -> None:
+        tamanho = os.path.getsize(temp)
+        with self.__lock:
+            os.replace(temp, os.path.join(self.__pasta, nome))
+            self.__total += tamanho - self.__entradas.pop(nome, 0)
+            self.__entradas[nome] = tamanho
+            self.__evict()
+
+    # Deve ser chamado com o lock obtido.
+    def __tocar(self, nome: str) -> None:
+        self.__entradas.move_to_end(nome)
+        try:
+            os.utime(os.path.join(self.__pasta, nome))
+        except OSError:
+            pass
+
+    # Deve ser chamado com o lock obtido.
+    def __remover(self, nome: str) -> None:
+        self.__total -= self.__entradas.pop(nome, 0)
+        try:
+            os.remove(os.path.join(self.__pasta, nome))
+        except OSError:
+            pass
+
+    # Deve ser chamado com o lock obtido.
+    def __evict(self) -> None:
+        while self.__total > self.__limite and self.__entradas:
+            self.__remover(next(iter(self.__entradas)))
+
+    @property
+    def estatisticas(self) -> dict[str, int]:
+        with self.__lock:
+            return {
+                "acertos_pdf": self.__acertos_pdf,
+                "acertos_html": self.__acertos_html,
+                "faltas": self.__faltas,
+                "entradas": len(self.__entradas),
+                "bytes": self.__total,
+                "limite": self.__limite,
+            }
\ No newline at end of file
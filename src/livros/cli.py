@@ -1,73 +1,211 @@
 import livros
-from livros.model import Biblioteca, File
-from livros.server import ServidorLivros
+from livros.model import Biblioteca, Dir, File
+from livros.observador import Observador
+from livros.motor import motores, motor_padrao
+from livros.registro import RegistroSQLite
+from livros.eventos import DEPURACAO, INFO, SaidaJsonl, barramento
+from livros.daemon import Daemon, compilar_no_daemon, endereco_padrao
 import sys, os
-from mypy.util import FancyFormatter
 
 formas_de_uso = """
 Formas de uso:
-    compilar_livros <nome-do-pacote> [<nome-do-zip>]
+    compilar_livros <nome-do-pacote> [<nome-do-zip>] [-t <trabalhadores>] [-c <megabytes>] [-m <motor>] [-i <dpi>] [-d] [-l <arquivo> [-v]] [-s <endereço>] [--local] [--watch]
     servidor_livros <opções>*
+    daemon_livros [-s <endereço>] [-n <navegadores>] [-t <trabalhadores>] [-c <megabytes>] [-m <motor>] [-i <dpi>] [-d] [-j <pacotes>] [-f <tamanho-da-fila>] [-l <arquivo> [-v]]
 
 Onde:
 * <nome-do-pacote> é o nome de alguma pasta ou arquivo ZIP contendo arquivos HTML junto com CSS, fontes e imagens.
 * <nome-do-zip> é o nome do ZIP a ser produzido como resultado. Se omitido, o nome será deduzido a partir do nome do pacote.
+* [-t <trabalhadores>], [-c <megabytes>], [-m <motor>], [-i <dpi>], [-d], [-l <arquivo>] e [-v] no compilar_livros funcionam como descrito nas opções abaixo.
+* daemon_livros fica aberto, com os módulos já carregados, um navegador aberto e os caches em memória, montando os pacotes pedidos
+  pelo compilar_livros. Enquanto ele estiver aberto, o compilar_livros só envia o pacote e mostra o andamento, economizando
+  os segundos de inicialização. Nesse caso, valem as opções -n, -t, -c, -i, -d e -l do daemon_livros, e o -m do compilar_livros
+  (ou, se omitido, o do daemon_livros). Os pedidos de vários compilar_livros ao mesmo tempo esperam numa fila, como no servidor,
+  e o -j e o -f do daemon_livros funcionam como descrito nas opções abaixo, mas o -j, se omitido, será 1.
+* [-s <endereço>] é o socket Unix (ou, no Windows, o named pipe) por onde o daemon_livros e o compilar_livros se comunicam. Se
+  omitido, é um por usuário, na pasta temporária do sistema.
+* [--local] faz o compilar_livros montar o pacote ele mesmo, ainda que o daemon_livros esteja aberto.
+* [--watch] faz o compilar_livros continuar observando a pasta do pacote depois de montá-lo. A cada alteração, só os livros afetados
+  (os que usam algum template, CSS, fonte ou imagem alterado) são remontados e o ZIP é atualizado. Não funciona com arquivos ZIP.
 * <opções> são as seguintes:
 *** [-p <porta>] especifica o número da porta TCP a ser usada no servidor. Se omitido, será utilizada a porta 13013.
+*** [-n <navegadores>] especifica quantos navegadores headless ficam abertos para serem reaproveitados entre os livros. Se omitido, serão 2.
+*** [-t <trabalhadores>] especifica quantos livros de um mesmo pacote são montados em paralelo, cada um renderizando o seu PDF em um processo separado. Se omitido, os livros são montados um de cada vez.
+*** [-c <megabytes>] especifica o tamanho máximo da pasta "cache", onde ficam guardados os PDFs e HTMLs já gerados para que capítulos inalterados não sejam refeitos. Se omitido, serão 1024 MB. Com 0, o cache é desativado.
+*** [-m <motor>] especifica como o JavaScript das páginas é processado antes de gerar o PDF. Com "navegador", cada página é aberta no
+    Firefox. Com "local", não se usa navegador: os blocos de código são coloridos com o Pygments e as fórmulas do MathJax são convertidas
+    com o ziamath, e os demais scripts são ignorados. Com "auto", é como "local", mas as páginas com scripts que só funcionam no navegador
+    (ou sem o Pygments ou o ziamath instalados) vão para o Firefox. Se omitido, será "navegador". No servidor, cada pacote enviado pode
+    escolher o seu.
+*** [-i <dpi>] especifica que, antes de montar os livros, as imagens PNG e JPEG do pacote são reduzidas para essa resolução de impressão
+    (considerando uma página de até 18 x 25 cm) e recomprimidas. Imagens repetidas são processadas uma vez só e os resultados ficam no
+    cache. Deve ser pelo menos 96. Se omitido, ou com 0, as imagens não são alteradas. Não se aplica ao --watch.
+*** [-d] especifica que os livros muito grandes (com mais de 2 MB de HTML) são divididos nos capítulos (nos comentários
+    <!-- livros:parte -->, se houver, ou senão nos elementos section, article e h1 mais externos), e as partes são renderizadas em
+    paralelo pelos trabalhadores e depois juntadas num PDF só, com os marcadores, os links e a numeração das páginas. Isso reduz o
+    tempo e a memória usados por esses livros. Depende do pypdf. O target-counter e o counter(pages) só enxergam a própria parte, e
+    as regras de @page :first valem para a primeira página de cada parte.
+*** [-j <pacotes>] especifica quantos pacotes enviados ao servidor são montados ao mesmo tempo. Os demais aguardam em uma fila. Se omitido, serão 2.
+*** [-f <tamanho-da-fila>] especifica quantos pacotes podem aguardar na fila. Quando ela está cheia, novos envios são recusados. Se omitido, serão 32.
+*** [-q <megabytes>] especifica o espaço máximo a ser ocupado pela pasta "temp". Quando ele é ultrapassado, o zelador apaga os pacotes já concluídos que foram acessados há mais tempo. Se omitido, serão 2048 MB.
 *** [-z] especifica, quando presente, que o serviço zelador que apaga arquivos temporários antigos não será ativado.
+*** [-x <aceleração>] especifica que os ZIPs prontos são entregues por um proxy na frente do servidor, que também cuida dos downloads
+    parciais. Com "sendfile", o servidor responde com o cabeçalho X-Sendfile (Apache com mod_xsendfile, lighttpd). Com um prefixo
+    começando com "/", responde com X-Accel-Redirect para o prefixo seguido do caminho do ZIP dentro da pasta "temp" (nginx, com uma
+    location internal para a pasta "temp" nesse prefixo). Se omitido, o próprio servidor envia os arquivos.
+*** [-l <arquivo>] especifica um arquivo onde os eventos (o status dos pacotes e as ações do zelador) são acrescentados, um por linha,
+    em JSON, com o momento, o nível, o canal e a mensagem. Com [-v], inclui também os eventos de depuração (locks e navegadores).
+*** [-r <arquivo>] especifica um banco de dados SQLite onde ficam a fila e o estado dos pacotes, para que vários servidores (em
+    portas ou máquinas diferentes, atrás de um balanceador de carga) compartilhem o trabalho. Todos devem usar o mesmo arquivo e ver
+    as pastas "temp" e "cache" no mesmo caminho. Cada um monta até <pacotes> pacotes da fila e qualquer um responde pelo status e pelo
+    download. Se omitido, a fila e o estado ficam na memória do servidor.
 
 Exemplo:
     compilar_livros apostila_projeto.zip apostila.zip
-    servidor_livros -p 13579 -z"""
+    compilar_livros apostila_projeto.zip -t 8
+    compilar_livros apostila_projeto --watch -m auto
+    daemon_livros -t 4 -m auto
+    servidor_livros -p 13579 -n 4 -t 8 -j 2 -f 50 -z
+    servidor_livros -p 13014 -r /compartilhado/livros.db"""
 
 class UsoIncorreto(Exception):
     pass
 
 class Cli: # CLI = Command Line Interpreter
 
+    def __init__(self) -> None:
+        self.__argv = sys.argv[:] # As opções são removidas daqui à medida em que são lidas.
+
     def __compilar(self) -> None:
-        if len(sys.argv) == 4:
-            biblioteca = Biblioteca(print, False)
-            biblioteca.criar_pacote_zip_ou_dir(sys.argv[2], File(sys.argv[3])).assemble()
-        elif len(sys.argv) == 3:
-            biblioteca = Biblioteca(print, False)
-            biblioteca.criar_pacote_zip_ou_dir(sys.argv[2], None).assemble()
-        else:
+        trabalhadores = self.__opcao_int("-t", 1)
+        cache = self.__opcao_int("-c", 1024, 0)
+        motor = self.__opcao_str("-m", "", motores)
+        dpi = self.__opcao_int("-i", 0, 0)
+        observar = self.__opcao_flag("--watch")
+        dividir = self.__opcao_flag("-d")
+        endereco = self.__opcao_str("-s", endereco_padrao())
+        local = self.__opcao_flag("--local")
+        eventos = self.__opcao_eventos()
+        if len(self.__argv) not in [3, 4]:
             raise UsoIncorreto()
+        nome_dest = self.__argv[3] if len(self.__argv) == 4 else None
 
-    def __servidor(self) -> None:
+        # O daemon, se estiver aberto, monta o pacote com os seus próprios recursos e registra os seus próprios eventos.
+        if not observar and not local and compilar_no_daemon(endereco, self.__argv[2], nome_dest, motor or None, print):
+            if eventos is not None: eventos.fechar()
+            return
 
-        argvs = 1
-        porta = 13013
-        if "-p" in sys.argv[1:]:
-            idx = sys.argv.index("-p")
-            if idx == len(sys.argv) - 1:
-                raise UsoIncorreto()
-            try:
-                porta = int(sys.argv[idx + 1])
-            except ValueError as x:
-                raise UsoIncorreto()
-            argvs += 2
+        dest = None if nome_dest is None else File(nome_dest)
+        biblioteca = Biblioteca(print, False, trabalhadores, trabalhadores, cache * 1024 * 1024, motor = motor or motor_padrao, dpi_imagens = dpi, dividir = dividir)
+        try:
+            if observar:
+                Observador(print, biblioteca.recursos, Dir(self.__argv[2]), dest).executar()
+            else:
+                biblioteca.criar_pacote_zip_ou_dir(self.__argv[2], dest).assemble()
+        finally:
+            biblioteca.encerrar()
+            if eventos is not None: eventos.fechar()
+
+    def __opcao_eventos(self) -> SaidaJsonl | None:
+        arquivo = self.__opcao_str("-l", "")
+        depurar = self.__opcao_flag("-v")
+        if arquivo == "":
+            if depurar: raise UsoIncorreto()
+            return None
+        saida = SaidaJsonl(arquivo)
+        barramento.assinar(saida, "", DEPURACAO if depurar else INFO)
+        return saida
+
+    def __opcao_int(self, opcao: str, padrao: int, minimo: int = 1) -> int:
+        if opcao not in self.__argv[2:]:
+            return padrao
+        idx = self.__argv.index(opcao, 2)
+        if idx == len(self.__argv) - 1:
+            raise UsoIncorreto()
+        try:
+            valor = int(self.__argv[idx + 1])
+        except ValueError as x:
+            raise UsoIncorreto()
+        if valor < minimo:
+            raise UsoIncorreto()
+        del self.__argv[idx:idx + 2]
+        return valor
+
+    def __opcao_str(self, opcao: str, padrao: str, valores: list[str] | None = None) -> str:
+        if opcao not in self.__argv[2:]:
+            return padrao
+        idx = self.__argv.index(opcao, 2)
+        if idx == len(self.__argv) - 1 or (valores is not None and self.__argv[idx + 1] not in valores):
+            raise UsoIncorreto()
+        valor = self.__argv[idx + 1]
+        del self.__argv[idx:idx + 2]
+        return valor
 
-        zelador = True
-        if "-z" not in sys.argv[1:]:
-            zelador = False
-            argvs += 1
+    def __opcao_flag(self, opcao: str) -> bool:
+        if opcao not in self.__argv[2:]:
+            return False
+        self.__argv.remove(opcao)
+        return True
 
-        if len(sys.argv) != argvs:
+    def __daemon(self) -> None:
+        endereco = self.__opcao_str("-s", endereco_padrao())
+        navegadores = self.__opcao_int("-n", 1)
+        trabalhadores = self.__opcao_int("-t", 1)
+        cache = self.__opcao_int("-c", 1024, 0)
+        motor = self.__opcao_str("-m", motor_padrao, motores)
+        dpi = self.__opcao_int("-i", 0, 0)
+        dividir = self.__opcao_flag("-d")
+        pacotes = self.__opcao_int("-j", 1)
+        fila = self.__opcao_int("-f", 32)
+        self.__opcao_eventos()
+
+        if len(self.__argv) != 2:
             raise UsoIncorreto()
 
-        biblioteca = Biblioteca(print, zelador)
-        ServidorLivros(biblioteca, porta).start()
+        biblioteca = Biblioteca(print, False, navegadores, trabalhadores, cache * 1024 * 1024, pacotes, fila, motor = motor, dpi_imagens = dpi, dividir = dividir)
+        try:
+            print("Carregando...")
+            biblioteca.recursos.aquecer()
+            Daemon(biblioteca, endereco, print).executar()
+        finally:
+            biblioteca.encerrar()
+
+    def __servidor(self) -> None:
+        from livros.server import ServidorLivros
+        porta = self.__opcao_int("-p", 13013)
+        navegadores = self.__opcao_int("-n", 2)
+        trabalhadores = self.__opcao_int("-t", 1)
+        cache = self.__opcao_int("-c", 1024, 0)
+        motor = self.__opcao_str("-m", motor_padrao, motores)
+        dpi = self.__opcao_int("-i", 0, 0)
+        pacotes = self.__opcao_int("-j", 2)
+        fila = self.__opcao_int("-f", 32)
+        cota = self.__opcao_int("-q", 2048)
+        zelador = not self.__opcao_flag("-z")
+        dividir = self.__opcao_flag("-d")
+        arquivo_registro = self.__opcao_str("-r", "")
+        acelerar = self.__opcao_str("-x", "")
+        self.__opcao_eventos()
+
+        if len(self.__argv) != 2:
+            raise UsoIncorreto()
+
+        registro = None if arquivo_registro == "" else RegistroSQLite(arquivo_registro)
+        biblioteca = Biblioteca(print, zelador, navegadores, trabalhadores, cache * 1024 * 1024, pacotes, fila, cota * 1024 * 1024, motor = motor, dpi_imagens = dpi, registro = registro, dividir = dividir)
+        if acelerar != "sendfile" and acelerar != "" and not acelerar.startswith("/"):
+            raise UsoIncorreto()
+        ServidorLivros(biblioteca, porta, acelerar or None).start()
 
     def __main(self) -> None:
         try:
-            if len(sys.argv) < 2:
+            if len(self.__argv) < 2:
                 raise UsoIncorreto()
-            if sys.argv[1] == "compilar_livros":
+            if self.__argv[1] == "compilar_livros":
                 self.__compilar()
-            elif sys.argv[1] == "servidor_livros":
+            elif self.__argv[1] == "servidor_livros":
                 self.__servidor()
+            elif self.__argv[1] == "daemon_livros":
+                self.__daemon()
             else:
                 raise UsoIncorreto()
         except UsoIncorreto as x:
@@ -87,6 +225,7 @@ class Cli: # CLI = Command Line Interpreter
             os.dup2(devnull, sys.stdout.fileno())
             sys.exit(2)
         except KeyboardInterrupt:
+            from mypy.util import FancyFormatter
             formatter = FancyFormatter(sys.stdout, sys.stderr, False)
             msg = "Execução interrompida\n"
             sys.stdout.write(formatter.style(msg, color = "red", bold = True))
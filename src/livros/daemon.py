@@ -0,0 +1,132 @@
+import livros
+from livros.model import Biblioteca, File
+from livros.agendador import FilaCheia
+from multiprocessing.connection import Client, Connection, Listener
+from threading import Thread
+from typing import Any, Callable
+import getpass, json, os, tempfile
+
+intervalo_status = 5.0
+
+# Um socket Unix na pasta temporária do sistema ou, no Windows, um named pipe. Um por usuário.
+def endereco_padrao() -> str:
+    if os.name == "nt": return rf"\\.\pipe\livros-{getpass.getuser()}"
+    return os.path.join(tempfile.gettempdir(), f"livros-{os.getuid()}.sock")
+
+def familia(endereco: str) -> str:
+    return "AF_PIPE" if endereco.startswith("\\\\.\\pipe\\") else "AF_UNIX"
+
+def enviar(c: Connection, mensagem: dict[str, Any]) -> None:
+    c.send_bytes(json.dumps(mensagem).encode("utf-8"))
+
+def receber(c: Connection) -> dict[str, Any]:
+    mensagem: dict[str, Any] = json.loads(c.recv_bytes().decode("utf-8"))
+    return mensagem
+
+# O ZIP de saída padrão, calculado como em Pacote, mas aqui no cliente, pois o diretório atual do daemon é outro.
+# Devolve None se src não existir, e então o próprio daemon recusa o pedido.
+def saida_padrao(src: str) -> str | None:
+    origem = os.path.abspath(src)
+    pasta, nome = os.path.split(origem)
+    if os.path.isfile(origem): return os.path.join(pasta, f"out-{nome}")
+    if os.path.isdir(origem): return os.path.join(pasta, f"out-{nome}.zip")
+    return None
+
+# Pede ao daemon que monte o pacote, repassando ao notify as linhas de status à medida em que chegam.
+# Devolve False se não houver daemon no endereço. Lança uma exceção com a falha se o pacote falhar.
+def compilar_no_daemon(endereco: str, src: str, dest: str | None, motor: str | None, notify: Callable[[str], None]) -> bool:
+    try:
+        c = Client(endereco, familia(endereco))
+    except OSError:
+        return False
+    with c:
+        enviar(c, {"src": os.path.abspath(src), "dest": saida_padrao(src) if dest is None else os.path.abspath(dest), "motor": motor})
+        while True:
+            mensagem = receber(c)
+            if "linha" in mensagem:
+                notify(mensagem["linha"])
+                continue
+            if mensagem["falha"] is not None: raise Exception(mensagem["falha"])
+            return True
+
+# Mantém uma biblioteca aberta, com os módulos importados, os navegadores abertos e os caches carregados, e monta
+# os pacotes pedidos pelo compilar_livros. Cada pedido é uma conexão: o cliente envia o pacote e recebe as linhas de
+# status e, por fim, o resultado. As mensagens são objetos JSON. Os pacotes são descartados ao terminar, mas o ZIP
+# de saída, que fica fora da pasta temp, permanece.
+# Os pacotes passam pelo agendador da biblioteca, como no servidor: só os pacotes_simultaneos dela são montados ao
+# mesmo tempo, os demais aguardam na fila, e quando ela está cheia o pedido é recusado. Cada conexão é um cliente.
+# Se o cliente desconectar no meio, o pacote continua sendo montado.
+class Daemon:
+
+    def __init__(self, biblioteca: Biblioteca, endereco: str, notify: Callable[[str], None]) -> None:
+        self.__biblioteca = biblioteca
+        self.__endereco = endereco
+        self.__notify = notify
+
+    def executar(self) -> None:
+        f = familia(self.__endereco)
+        if f == "AF_UNIX" and os.path.exists(self.__endereco):
+            try:
+                Client(self.__endereco, f).close()
+            except OSError:
+                os.remove(self.__endereco)
+            else:
+                raise Exception(f"Já existe um daemon em {self.__endereco}.")
+        # O socket já é criado acessível só pelo dono, sem um intervalo em que outros usuários possam se conectar.
+        anterior = os.umask(0o177) if f == "AF_UNIX" else None
+        try:
+            ouvinte = Listener(self.__endereco, f)
+        finally:
+            if anterior is not None: os.umask(anterior)
+        with ouvinte:
+            self.__notify(f"Aguardando pacotes em {self.__endereco}. Pressione Ctrl+C para encerrar.")
+            conexoes = 0
+            while True:
+                c = ouvinte.accept()
+                conexoes += 1
+                t = Thread(target = self.__atender, args = (c, f"daemon-{conexoes}"), name = "daemon")
+                t.daemon = True
+                t.start()
+
+    def __atender(self, c: Connection, cliente: str) -> None:
+        with c:
+            try:
+                pedido = receber(c)
+                dest = None if pedido["dest"] is None else File(pedido["dest"])
+                p = self.__biblioteca.criar_pacote_zip_ou_dir(pedido["src"], dest, pedido["motor"])
+            except Exception as x:
+                enviar(c, {"falha": str(x)})
+                return
+            try:
+                self.__biblioteca.agendar(p, cliente)
+            except FilaCheia as x:
+                enviar(c, {"falha": str(x)})
+                return
+            conectado = True
+            posicao = self.__biblioteca.posicao_na_fila(p)
+            if posicao is not None: conectado = self.__enviar_linha(c, f"[{p.nome}] Aguardando na fila, na posição {posicao}...")
+
+            # O status é lido do próprio pacote até que ele termine, mesmo que o cliente tenha desconectado, e só então
+            # o pacote é descartado.
+            cursor = 0
+            while True:
+                concluido = p.pronto is not None
+                cursor, linhas = p.status_desde(cursor) if concluido else p.aguardar_status(cursor, intervalo_status)
+                for linha in linhas:
+                    if conectado: conectado = self.__enviar_linha(c, f"[{p.nome}] {linha}")
+                if concluido: break
+            self.__biblioteca.descartar_pacote(p)
+            if conectado:
+                try:
+                    enviar(c, {"falha": p.falha})
+                except OSError:
+                    pass
+
+    # Devolve False se o cliente tiver desconectado.
+    @staticmethod
+    def __enviar_linha(c: Connection, linha: str) -> bool:
+        try:
+            enviar(c, {"linha": linha})
+            return True
+        except OSError:
+            return False
\ No newline at end of file
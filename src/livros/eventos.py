@@ -0,0 +1,162 @@
+import livros
+from abc import ABC, abstractmethod
+from threading import Event, RLock, Thread
+from queue import SimpleQueue
+from typing import Any, Callable, NamedTuple
+import json, time, traceback
+
+DEPURACAO = 10
+INFO = 20
+AVISO = 30
+ERRO = 40
+nomes_niveis = {DEPURACAO: "depuracao", INFO: "info", AVISO: "aviso", ERRO: "erro"}
+sem_assinantes = ERRO + 1
+
+class Evento(NamedTuple):
+    momento: float
+    nivel: int
+    canal: str
+    mensagem: str
+    campos: dict[str, Any]
+
+    # Nos canais com identificador, como pacote.<nome>, o identificador vem antes da mensagem, entre colchetes.
+    @property
+    def texto(self) -> str:
+        if "." not in self.canal: return self.mensagem
+        return f"[{self.canal[self.canal.index('.') + 1:]}] {self.mensagem}"
+
+Assinante = Callable[[Evento], None]
+
+# Os eventos são publicados em canais como "lock", "zelador", "navegador" ou "pacote.<nome>". Quem assina um canal
+# recebe também os eventos dos canais abaixo dele ("pacote" recebe os de todos os pacotes e "" recebe tudo), desde que
+# tenham pelo menos o nível pedido.
+# Os assinantes são chamados na thread que publicou, então precisam ser rápidos. Saídas lentas, como arquivos e o
+# terminal, devem usar uma SaidaAssincrona.
+# Publicar num nível que nenhum assinante quer custa só uma comparação. Para que montar a mensagem também não custe
+# nada, quem publica em níveis de depuração deve antes consultar habilitado.
+# As assinaturas nunca são alteradas, e sim substituídas, de forma que publicar não precisa do lock.
+class Barramento:
+
+    def __init__(self) -> None:
+        self.__lock = RLock()
+        self.__assinaturas: dict[str, tuple[tuple[int, int, Assinante], ...]] = {} # Substituído, guardado pelo lock.
+        self.__minimo = sem_assinantes                                             # Substituído, guardado pelo lock.
+        self.__proxima = 0                                                         # Mutável, guardado pelo lock.
+
+    def habilitado(self, nivel: int) -> bool:
+        return nivel >= self.__minimo
+
+    # Devolve a assinatura, para ser cancelada depois.
+    def assinar(self, assinante: Assinante, canal: str = "", nivel: int = INFO) -> int:
+        with self.__lock:
+            self.__proxima += 1
+            assinaturas = dict(self.__assinaturas)
+            assinaturas[canal] = assinaturas.get(canal, ()) + ((self.__proxima, nivel, assinante),)
+            self.__substituir(assinaturas)
+            return self.__proxima
+
+    def cancelar(self, assinatura: int) -> None:
+        with self.__lock:
+            assinaturas: dict[str, tuple[tuple[int, int, Assinante], ...]] = {}
+            for canal, lista in self.__assinaturas.items():
+                restantes = tuple(a for a in lista if a[0] != assinatura)
+                if restantes: assinaturas[canal] = restantes
+            self.__substituir(assinaturas)
+
+    # Deve ser chamado com o lock obtido.
+    def __substituir(self, assinaturas: dict[str, tuple[tuple[int, int, Assinante], ...]]) -> None:
+        self.__assinaturas = assinaturas
+        self.__minimo = min((n for lista in assinaturas.values() for _, n, _ in lista), default = sem_assinantes)
+
+    def publicar(self, nivel: int, canal: str, mensagem: str, **campos: Any) -> None:
+        if nivel < self.__minimo: return
+        assinaturas = self.__assinaturas
+        evento: Evento | None = None
+        assinado = canal
+        while True:
+            for _, minimo, assinante in assinaturas.get(assinado, ()):
+                if nivel < minimo: continue
+                if evento is None: evento = Evento(time.time(), nivel, canal, mensagem, campos)
+                assinante(evento)
+            if assinado == "": return
+            assinado = assinado[:assinado.rindex(".")] if "." in assinado else ""
+
+barramento = Barramento()
+
+# Recebe os eventos de quem publica e os entrega, na ordem, numa thread própria. Descarrega a saída sempre que a
+# fila fica vazia, de forma que vários eventos seguidos são escritos de uma vez.
+class SaidaAssincrona(ABC):
+
+    def __init__(self) -> None:
+        self.__fila: SimpleQueue[Evento | Event | None] = SimpleQueue()
+        self.__thread = Thread(target = self.__trabalhar, name = type(self).__name__)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __call__(self, evento: Evento) -> None:
+        self.__fila.put(evento)
+
+    def __trabalhar(self) -> None:
+        while True:
+            evento = self.__fila.get()
+            if evento is None:
+                self.descarregar()
+                return
+            if isinstance(evento, Event):
+                try:
+                    self.descarregar()
+                except Exception:
+                    traceback.print_exc()
+                evento.set()
+                continue
+            try:
+                self.escrever(evento)
+                if self.__fila.empty(): self.descarregar()
+            except Exception:
+                traceback.print_exc()
+
+    @abstractmethod
+    def escrever(self, evento: Evento) -> None:
+        ...
+
+    def descarregar(self) -> None:
+        pass
+
+    # Espera que os eventos já recebidos sejam entregues, sem encerrar a saída.
+    def esvaziar(self) -> None:
+        entregues = Event()
+        self.__fila.put(entregues)
+        entregues.wait()
+
+    # Espera que os eventos já recebidos sejam entregues.
+    def fechar(self) -> None:
+        self.__fila.put(None)
+        self.__thread.join()
+
+class SaidaTexto(SaidaAssincrona):
+
+    def __init__(self, notify: Callable[[str], None]) -> None:
+        self.__notify = notify
+        super().__init__()
+
+    def escrever(self, evento: Evento) -> None:
+        self.__notify(evento.texto)
+
+# Uma linha JSON por evento, com o momento, o nível, o canal, a mensagem e os campos do evento.
+class SaidaJsonl(SaidaAssincrona):
+
+    def __init__(self, arquivo: str) -> None:
+        self.__arquivo = open(arquivo, "a", encoding = "utf-8", buffering = 1024 * 1024)
+        super().__init__()
+
+    def escrever(self, evento: Evento) -> None:
+        linha = {"momento": evento.momento, "nivel": nomes_niveis.get(evento.nivel, evento.nivel), "canal": evento.canal, "mensagem": evento.mensagem}
+        linha.update(evento.campos)
+        self.__arquivo.write(json.dumps(linha, ensure_ascii = False, default = str) + "\n")
+
+    def descarregar(self) -> None:
+        self.__arquivo.flush()
+
+    def fechar(self) -> None:
+        super().fechar()
+        self.__arquivo.close()
\ No newline at end of file
@@ -0,0 +1,106 @@
+import livros
+from livros.cache import CacheLivros
+import hashlib, os, shutil
+
+largura_maxima_cm = 18.0
+altura_maxima_cm = 25.0
+qualidade_jpeg = 85
+formatos = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG"}
+
+# Reduz as imagens de um pacote para a resolução de impressão desejada e as recomprime, mantendo nome e formato,
+# de forma que o HTML e o CSS continuam valendo. O limite é o tamanho de uma página inteira na resolução pedida,
+# e como a resolução mínima é 96 DPI (a do pixel do CSS), uma imagem reduzida continua pelo menos tão grande
+# quanto a página e é mostrada do mesmo tamanho por um CSS que limite a sua largura.
+# Imagens idênticas são processadas uma vez só e passam a ser o mesmo arquivo. Os resultados ficam no cache dos
+# livros, identificados pelo hash do conteúdo original, inclusive quando não vale a pena mexer na imagem.
+# Depende do Pillow, que já vem com o WeasyPrint. Sem ele, nada é feito.
+class OtimizadorImagens:
+
+    def __init__(self, dpi: int, cache: CacheLivros | None) -> None:
+        if dpi < 96: raise Exception(f"A resolução das imagens deve ser de pelo menos 96 DPI, mas foi {dpi}.")
+        self.__dpi = dpi
+        self.__cache = cache
+        self.__largura = round(largura_maxima_cm / 2.54 * dpi)
+        self.__altura = round(altura_maxima_cm / 2.54 * dpi)
+
+    @property
+    def dpi(self) -> int:
+        return self.__dpi
+
+    # Altera os arquivos da pasta, que deve ser uma cópia do pacote. Devolve as contagens do que foi feito.
+    def otimizar(self, pasta: str) -> dict[str, int]:
+        resultado = {"imagens": 0, "duplicadas": 0, "reduzidas": 0, "do_cache": 0, "bytes_antes": 0, "bytes_depois": 0}
+        try:
+            import PIL
+        except ImportError:
+            return resultado
+        por_hash: dict[str, list[str]] = {}
+        for raiz, _, arquivos in os.walk(pasta):
+            for a in arquivos:
+                if "." not in a or a[a.rindex(".") + 1:].lower() not in formatos: continue
+                caminho = os.path.join(raiz, a)
+                por_hash.setdefault(OtimizadorImagens.__hash(caminho), []).append(caminho)
+        for h, caminhos in sorted(por_hash.items()):
+            primeiro = caminhos[0]
+            antes = os.path.getsize(primeiro)
+            situacao = self.__otimizar_imagem(h, primeiro)
+            depois = os.path.getsize(primeiro)
+            resultado["imagens"] += len(caminhos)
+            resultado["duplicadas"] += len(caminhos) - 1
+            resultado["bytes_antes"] += antes * len(caminhos)
+            resultado["bytes_depois"] += depois * len(caminhos)
+            if situacao == "cache": resultado["do_cache"] += 1
+            if depois < antes: resultado["reduzidas"] += 1
+            for outro in caminhos[1:]:
+                os.remove(outro)
+                try:
+                    os.link(primeiro, outro)
+                except OSError:
+                    shutil.copyfile(primeiro, outro)
+        return resultado
+
+    @staticmethod
+    def __hash(caminho: str) -> str:
+        h = hashlib.sha256()
+        with open(caminho, "rb") as f:
+            for bloco in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(bloco)
+        return h.hexdigest()
+
+    def __otimizar_imagem(self, h: str, caminho: str) -> str:
+        extensao = caminho[caminho.rindex(".") + 1:].lower()
+        nome = f"imagem-{h}-{self.__dpi}.{extensao}"
+        if self.__cache is not None:
+            if self.__cache.existe(f"{nome}.original"): return "cache"
+            if self.__cache.obter_arquivo(nome, caminho): return "cache"
+        if self.__recomprimir(caminho, formatos[extensao]):
+            if self.__cache is not None: self.__cache.guardar_arquivo(nome, caminho)
+            return "otimizada"
+        if self.__cache is not None: self.__cache.marcar(f"{nome}.original")
+        return "original"
+
+    # Só substitui o arquivo se o resultado for menor.
+    def __recomprimir(self, caminho: str, formato: str) -> bool:
+        from PIL import Image, ImageOps
+        temp = f"{caminho}.tmp"
+        try:
+            with Image.open(caminho) as original:
+                if getattr(original, "is_animated", False): return False
+                imagem = ImageOps.exif_transpose(original)
+                escala = min(1.0, self.__largura / imagem.width, self.__altura / imagem.height)
+                if escala < 1.0:
+                    tamanho = (max(1, round(imagem.width * escala)), max(1, round(imagem.height * escala)))
+                    imagem = imagem.resize(tamanho, Image.Resampling.LANCZOS)
+                if formato == "JPEG":
+                    if imagem.mode not in ("RGB", "L", "CMYK"): imagem = imagem.convert("RGB")
+                    imagem.save(temp, "JPEG", quality = qualidade_jpeg, optimize = True, progressive = True)
+                else:
+                    imagem.save(temp, "PNG", optimize = True)
+        except Exception:
+            if os.path.exists(temp): os.remove(temp)
+            return False
+        if os.path.getsize(temp) >= os.path.getsize(caminho):
+            os.remove(temp)
+            return False
+        os.replace(temp, caminho)
+        return True
\ No newline at end of file
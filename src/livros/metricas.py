@@ -0,0 +1,114 @@
+import livros
+from contextlib import contextmanager
+from threading import RLock
+from typing import Iterator
+import bisect, time
+
+limites_segundos = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+limites_paginas = [1.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0]
+limites_bytes = [1e4, 1e5, 1e6, 1e7, 1e8, 1e9]
+
+def serie(nome: str, rotulos: str) -> str:
+    return f"{nome}{{{rotulos}}}" if rotulos else nome
+
+class Histograma:
+
+    def __init__(self, limites: list[float]) -> None:
+        self.__limites = limites
+        self.__contagens = [0] * (len(limites) + 1)
+        self.__soma = 0.0
+
+    def observar(self, valor: float) -> None:
+        self.__contagens[bisect.bisect_left(self.__limites, valor)] += 1
+        self.__soma += valor
+
+    def exportar(self, nome: str, rotulos: str) -> list[str]:
+        linhas = []
+        acumulado = 0
+        separador = "," if rotulos else ""
+        for limite, contagem in zip(self.__limites + [float("inf")], self.__contagens):
+            acumulado += contagem
+            le = "+Inf" if limite == float("inf") else f"{limite}"
+            linhas.append(f'{nome}_bucket{{{rotulos}{separador}le="{le}"}} {acumulado}')
+        linhas.append(f"{serie(nome + '_sum', rotulos)} {self.__soma}")
+        linhas.append(f"{serie(nome + '_count', rotulos)} {acumulado}")
+        return linhas
+
+# Métricas do processo inteiro, exportadas no formato texto do Prometheus. Os rótulos já vêm formatados, como 'etapa="jinja"'.
+class Metricas:
+
+    def __init__(self) -> None:
+        self.__lock = RLock()
+        self.__histogramas: dict[str, dict[str, Histograma]] = {} # Mutável, guardado pelo lock.
+        self.__contadores: dict[str, dict[str, float]] = {}       # Mutável, guardado pelo lock.
+
+    def observar(self, nome: str, valor: float, rotulos: str = "", limites: list[float] = limites_segundos) -> None:
+        with self.__lock:
+            por_rotulo = self.__histogramas.setdefault(nome, {})
+            if rotulos not in por_rotulo: por_rotulo[rotulos] = Histograma(limites)
+            por_rotulo[rotulos].observar(valor)
+
+    def incrementar(self, nome: str, rotulos: str = "", valor: float = 1) -> None:
+        with self.__lock:
+            por_rotulo = self.__contadores.setdefault(nome, {})
+            por_rotulo[rotulos] = por_rotulo.get(rotulos, 0) + valor
+
+    # Os valores instantâneos (tamanho da fila, uso do cache, etc.) são lidos por quem exporta e passados como medidores.
+    def exportar(self, medidores: dict[str, float]) -> str:
+        linhas = []
+        with self.__lock:
+            for nome, por_rotulo in sorted(self.__histogramas.items()):
+                linhas.append(f"# TYPE {nome} histogram")
+                for rotulos, h in sorted(por_rotulo.items()):
+                    linhas += h.exportar(nome, rotulos)
+            for nome, valores in sorted(self.__contadores.items()):
+                linhas.append(f"# TYPE {nome} counter")
+                for rotulos, valor in sorted(valores.items()):
+                    linhas.append(f"{serie(nome, rotulos)} {valor}")
+        for nome, valor in sorted(medidores.items()):
+            linhas.append(f"# TYPE {nome} gauge")
+            linhas.append(f"{nome} {valor}")
+        return "\n".join(linhas) + "\n"
+
+# Os tempos de cada etapa de um pacote. Tudo o que é registrado aqui também vai para as métricas do processo.
+class Tempos:
+
+    def __init__(self, metricas: Metricas) -> None:
+        self.__metricas = metricas
+        self.__lock = RLock()
+        self.__etapas: dict[str, tuple[float, int]] = {} # Mutável, guardado pelo lock.
+        self.__livros = 0                                 # Mutável, guardado pelo lock.
+        self.__paginas = 0                                # Mutável, guardado pelo lock.
+        self.__bytes = 0                                  # Mutável, guardado pelo lock.
+
+    @contextmanager
+    def medir(self, etapa: str) -> Iterator[None]:
+        inicio = time.monotonic()
+        try:
+            yield
+        finally:
+            self.registrar(etapa, time.monotonic() - inicio)
+
+    def registrar(self, etapa: str, segundos: float) -> None:
+        with self.__lock:
+            soma, vezes = self.__etapas.get(etapa, (0.0, 0))
+            self.__etapas[etapa] = (soma + segundos, vezes + 1)
+        self.__metricas.observar("livros_etapa_segundos", segundos, f'etapa="{etapa}"')
+
+    def livro(self, paginas: int, tamanho: int) -> None:
+        with self.__lock:
+            self.__livros += 1
+            self.__paginas += paginas
+            self.__bytes += tamanho
+        self.__metricas.observar("livros_paginas", paginas, limites = limites_paginas)
+        self.__metricas.observar("livros_pdf_bytes", tamanho, limites = limites_bytes)
+
+    @property
+    def resumo(self) -> dict[str, object]:
+        with self.__lock:
+            return {
+                "etapas": {etapa: {"segundos": round(soma, 3), "vezes": vezes} for etapa, (soma, vezes) in self.__etapas.items()},
+                "livros": self.__livros,
+                "paginas": self.__paginas,
+                "bytes": self.__bytes,
+            }
\ No newline at end of file
@@ -1,24 +1,86 @@
 import livros
-from typing import Callable
+from typing import Callable, IO, TYPE_CHECKING
 from abc import ABC, abstractmethod
 from glob import glob
-import os, shutil, time
+import hashlib, heapq, math, multiprocessing, os, shutil, socket, time, traceback
 from pathlib import PurePath
-from threading import RLock
+from threading import Condition, RLock
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from itertools import islice
 from threading import Thread, current_thread
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from livros.navegador import PoolNavegadores, abrir_firefox, aguardar_javascript
+from livros.cache import CacheLivros
+from livros.agendador import Agendador, FilaCheia
+from livros.metricas import Metricas, Tempos
+from livros.renderizacao import CacheWeasyPrint
+from livros.motor import motores, motor_padrao
+from livros.imagens import OtimizadorImagens
+from livros.registro import Registro, SaidaRegistro
+from livros.eventos import AVISO, DEPURACAO, ERRO, INFO, Evento, SaidaTexto, barramento
+import livros.partes
 
-debug_lock = False
-debug_zelador = True
 descanso_zelador = 60
-descanso_javascript = 5
+validade_pacote = timedelta(hours = 1)
+cota_temp = 2 * 1024 * 1024 * 1024
 limpeza_preguicosa = False
-
-def log_lock(x: str) -> None:
-    if debug_lock: print(x)
-
-def log_zelador(x: str) -> None:
-    if debug_zelador: print(x)
+limite_status = 500
+carencia_orfaos = 3600
+
+# Chamado a cada lock obtido, por isso só monta a mensagem se alguém quiser recebê-la.
+def log_lock(recurso: str, operacao: str, obtido: bool = False) -> None:
+    if not barramento.habilitado(DEPURACAO): return
+    barramento.publicar(DEPURACAO, "lock", f"[lock] {recurso} ({operacao}){' obtido.' if obtido else '...'}", recurso = recurso, operacao = operacao, obtido = obtido)
+
+def log_zelador(x: str, **campos: object) -> None:
+    barramento.publicar(INFO, "zelador", x, **campos)
+
+# Arquivos de texto são sempre extraídos, pois podem ser templates, folhas de estilo ou configurações incluídas
+# pelos templates. Os demais (imagens, fontes, etc.) só são extraídos se o seu nome aparecer em algum deles.
+extensoes_texto = ["html", "htm", "css", "js", "json", "txt", "svg", "xml"]
+
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+# O GTK usado pelo WeasyPrint só precisa ser carregado à mão no Windows.
+def import_dlls() -> None:
+    if os.name != "nt": return
+    import ctypes
+    dll_path = r"C:\Program Files\GTK3-Runtime Win64\bin"
+    for dll in ["gobject-2.0-0", "pango-1.0-0", "fontconfig-1", "pangoft2-1.0-0"]:
+        ctypes.WinDLL(dll_path + f"\\lib{dll}.dll")
+
+def iniciar_renderizador(limite_weasyprint: int) -> None:
+    import_dlls()
+    livros.renderizacao.configurar(limite_weasyprint)
+
+def aquecer_renderizador() -> None:
+    import weasyprint
+
+# Roda tanto no processo principal quanto nos processos de renderização, usando o cache do WeasyPrint do processo.
+# Devolve o tempo do render, o tempo do write_pdf, o número de páginas e os contadores do cache.
+def gerar_pdf(html_content: str, output: str, pacote: str) -> tuple[float, float, int, dict[str, int]]:
+    render, escrita, paginas, contadores, _ = gerar_parte(html_content, output, pacote)
+    return render, escrita, paginas, contadores
+
+# Como gerar_pdf, mas devolve também as âncoras: para cada uma, a página e a posição em pixels do CSS a partir do canto
+# superior esquerdo dela.
+def gerar_parte(html_content: str, output: str, pacote: str) -> tuple[float, float, int, dict[str, int], dict[str, tuple[int, float, float]]]:
+    import weasyprint
+    cache = livros.renderizacao.cache_processo
+    if cache is None: cache = livros.renderizacao.configurar(livros.renderizacao.limite_weasyprint)
+    font_config, imagens = cache.pacote(pacote)
+    inicio = time.monotonic()
+    documento = weasyprint.HTML(string = html_content, url_fetcher = cache.url_fetcher()).render(font_config = font_config, cache = imagens)
+    meio = time.monotonic()
+    documento.write_pdf(output)
+    cache.medir_pacote(pacote)
+    ancoras: dict[str, tuple[int, float, float]] = {}
+    for i, pagina in enumerate(documento.pages):
+        for nome, (x, y) in pagina.anchors.items():
+            ancoras.setdefault(nome, (i, x, y))
+    return meio - inicio, time.monotonic() - meio, len(documento.pages), cache.retirar_contadores(), ancoras
 
 class DirOrFile(ABC):
 
@@ -33,7 +95,7 @@ class DirOrFile(ABC):
 
     @property
     def url(self) -> str:
-        return "file:///" + self.absolute_name
+        return PurePath(self.absolute_name).as_uri()
 
     @property
     def local_name(self) -> str:
@@ -67,6 +129,17 @@ class Dir(DirOrFile):
     def exists(self) -> bool:
         return os.path.exists(self.absolute_name) and not os.path.isfile(self.absolute_name)
 
+    @property
+    def size(self) -> int:
+        total = 0
+        for raiz, _, arquivos in os.walk(self.absolute_name):
+            for a in arquivos:
+                try:
+                    total += os.path.getsize(os.path.join(raiz, a))
+                except OSError:
+                    pass
+        return total
+
     def mkdir(self) -> None:
         if not self.exists: os.mkdir(self.absolute_name)
 
@@ -113,10 +186,32 @@ class File(DirOrFile):
     def kill(self) -> None:
         if self.exists: os.remove(self.absolute_name)
 
-    def extract_to(self, target: Dir) -> None:
+    def extract_to(self, target: Dir) -> tuple[int, int]:
+        with open(self.absolute_name, "rb") as f:
+            return File.extract_stream_to(f, target)
+
+    # Devolve quantos arquivos foram extraídos e quantos havia no ZIP.
+    @staticmethod
+    def extract_stream_to(stream: IO[bytes], target: Dir) -> tuple[int, int]:
         import zipfile
-        with zipfile.ZipFile(self.absolute_name, "r", metadata_encoding = "utf-8") as zf:
-            zf.extractall(target.absolute_name)
+        from urllib.parse import quote
+        with zipfile.ZipFile(stream, "r", metadata_encoding = "utf-8") as zf:
+            membros = [m for m in zf.infolist() if not m.is_dir()]
+            textos = [m for m in membros if "." in m.filename and m.filename[m.filename.rindex(".") + 1:].lower() in extensoes_texto]
+            corpus: list[str] = []
+            for m in textos:
+                corpus.append(zf.read(m).decode("utf-8", errors = "replace"))
+                zf.extract(m, target.absolute_name)
+            todo = "\n".join(corpus)
+            nomes_textos = {m.filename for m in textos}
+            extraidos = len(textos)
+            for m in membros:
+                if m.filename in nomes_textos: continue
+                base = m.filename[m.filename.rindex("/") + 1:] if "/" in m.filename else m.filename
+                if base in todo or quote(base) in todo:
+                    zf.extract(m, target.absolute_name)
+                    extraidos += 1
+            return extraidos, len(membros)
 
     @property
     def local_name_no_extension(self) -> str:
@@ -136,6 +231,53 @@ class File(DirOrFile):
         f = File(f"temp/{uuid.uuid4()}.{extensao}")
         return f
 
+# O zipfile só volta para corrigir os cabeçalhos já escritos quando a saída permite seek. Sem seek, ele usa
+# data descriptors, e assim o que já está no disco é sempre um prefixo do ZIP final, que pode ser transmitido
+# enquanto o resto ainda está sendo gerado.
+class SaidaSequencial:
+
+    def __init__(self, f: IO[bytes]) -> None:
+        self.__f = f
+        self.__posicao = 0
+
+    def write(self, b: bytes) -> int:
+        n = self.__f.write(b)
+        self.__posicao += n
+        return n
+
+    def tell(self) -> int:
+        return self.__posicao
+
+    def flush(self) -> None:
+        self.__f.flush()
+
+    def close(self) -> None:
+        self.__f.close()
+
+class ZipIncremental:
+
+    def __init__(self, target: File) -> None:
+        import zipfile
+        self.__lock = RLock()
+        self.__saida = SaidaSequencial(open(target.absolute_name, "wb"))
+        self.__zip = zipfile.ZipFile(self.__saida, "w", zipfile.ZIP_DEFLATED) # Guardado pelo lock.
+
+    def add(self, f: File) -> None:
+        log_lock("zip", "add")
+        with self.__lock:
+            log_lock("zip", "add", True)
+            self.__zip.write(f.absolute_name, f.local_name)
+            self.__saida.flush()
+
+    def close(self) -> None:
+        log_lock("zip", "close")
+        with self.__lock:
+            log_lock("zip", "close", True)
+            try:
+                self.__zip.close()
+            finally:
+                self.__saida.close()
+
 class UnsavedFile(ABC):
 
     def __init__(self, local_name: str) -> None:
@@ -149,53 +291,316 @@ class UnsavedFile(ABC):
     def save_to(self, d: Dir) -> File:
         ...
 
+    # Um stream posicionável com o conteúdo do arquivo, para lê-lo sem antes salvá-lo em disco.
+    @property
+    @abstractmethod
+    def stream(self) -> IO[bytes]:
+        ...
+
+    # O SHA-256 do conteúdo, lido do stream em blocos. O stream volta para o início em seguida.
+    def sha256(self) -> str:
+        s = self.stream
+        s.seek(0)
+        h = hashlib.sha256()
+        for bloco in iter(lambda: s.read(1024 * 1024), b""):
+            h.update(bloco)
+        s.seek(0)
+        return h.hexdigest()
+
+class Recursos:
+
+    def __init__(
+            self,
+            navegadores: int,
+            trabalhadores: int,
+            limite_cache: int,
+            abrir_navegador: Callable[[], "WebDriver"] = abrir_firefox,
+            limite_weasyprint: int = livros.renderizacao.limite_weasyprint,
+            motor: str = motor_padrao,
+            dpi_imagens: int = 0,
+            registro: Registro | None = None,
+            dividir: bool = False
+    ) -> None:
+        if trabalhadores < 1: raise Exception(f"O número de trabalhadores deve ser positivo, mas foi {trabalhadores}.")
+        if motor not in motores: raise Exception(f"O motor deve ser um de {', '.join(motores)}, mas foi {motor}.")
+        self.__motor = motor
+        self.__navegadores = PoolNavegadores(navegadores, abrir_navegador)
+        self.__trabalhadores = trabalhadores
+        if trabalhadores == 1:
+            self.__renderizadores = None
+            self.__weasyprint: CacheWeasyPrint | None = livros.renderizacao.configurar(limite_weasyprint)
+        else:
+            # Cada processo de renderização tem o seu próprio cache do WeasyPrint. Os processos são criados com spawn
+            # também fora do Windows, pois um fork copiaria as threads, os locks e os navegadores deste processo.
+            contexto = multiprocessing.get_context("spawn")
+            self.__renderizadores = ProcessPoolExecutor(trabalhadores, mp_context = contexto, initializer = iniciar_renderizador, initargs = (limite_weasyprint,))
+            self.__weasyprint = None
+        self.__cache = None if limite_cache == 0 else CacheLivros(limite = limite_cache)
+        self.__imagens = None if dpi_imagens == 0 else OtimizadorImagens(dpi_imagens, self.__cache)
+        self.__registro = registro
+        self.__dividir = dividir
+        self.__metricas = Metricas()
+
+        # Com um registro, o status dos pacotes montados aqui é gravado nele por uma única saída para todos eles.
+        self.__saida_registro = None if registro is None else SaidaRegistro(registro, limite_status)
+        self.__assinatura = None if self.__saida_registro is None else barramento.assinar(self.__saida_registro, "pacote", INFO)
+
+    @property
+    def navegadores(self) -> PoolNavegadores:
+        return self.__navegadores
+
+    @property
+    def trabalhadores(self) -> int:
+        return self.__trabalhadores
+
+    # O motor usado pelos pacotes que não escolhem nenhum.
+    @property
+    def motor(self) -> str:
+        return self.__motor
+
+    @property
+    def cache(self) -> CacheLivros | None:
+        return self.__cache
+
+    @property
+    def metricas(self) -> Metricas:
+        return self.__metricas
+
+    @property
+    def imagens(self) -> OtimizadorImagens | None:
+        return self.__imagens
+
+    @property
+    def registro(self) -> Registro | None:
+        return self.__registro
+
+    # Espera que as linhas de status já publicadas estejam gravadas no registro, se houver um.
+    def gravar_status(self) -> None:
+        if self.__saida_registro is not None: self.__saida_registro.esvaziar()
+
+    # Se os livros grandes são divididos em partes renderizadas separadamente.
+    @property
+    def dividir(self) -> bool:
+        return self.__dividir
+
+    # Só existe quando os PDFs são renderizados no próprio processo.
+    @property
+    def weasyprint(self) -> CacheWeasyPrint | None:
+        return self.__weasyprint
+
+    def gerar_pdf(self, html_content: str, output: File, pacote: str) -> tuple[float, float, int]:
+        if self.__renderizadores is None:
+            render, escrita, paginas, contadores = gerar_pdf(html_content, output.absolute_name, pacote)
+        else:
+            render, escrita, paginas, contadores = self.__renderizadores.submit(gerar_pdf, html_content, output.absolute_name, pacote).result()
+        for rotulos, n in contadores.items():
+            self.__metricas.incrementar("livros_weasyprint_cache_total", rotulos, n)
+        return render, escrita, paginas
+
+    # Renderiza as partes ao mesmo tempo, se houver processos de renderização, ou uma de cada vez. Assim, cada processo
+    # só tem o layout de uma parte em memória por vez.
+    def gerar_partes(self, partes: list[tuple[str, File]], pacote: str) -> list[tuple[float, float, int, dict[str, tuple[int, float, float]]]]:
+        if self.__renderizadores is None:
+            resultados = [gerar_parte(html_content, output.absolute_name, pacote) for html_content, output in partes]
+        else:
+            futuros = [self.__renderizadores.submit(gerar_parte, html_content, output.absolute_name, pacote) for html_content, output in partes]
+            try:
+                resultados = [f.result() for f in futuros]
+            except BaseException:
+                for f in futuros:
+                    f.cancel()
+                raise
+        for _, _, _, contadores, _ in resultados:
+            for rotulos, n in contadores.items():
+                self.__metricas.incrementar("livros_weasyprint_cache_total", rotulos, n)
+        return [(render, escrita, paginas, ancoras) for render, escrita, paginas, _, ancoras in resultados]
+
+    # Importa de antemão o que os livros vão usar, inicia os processos de renderização e abre um navegador,
+    # para que o primeiro livro não pague por isso.
+    def aquecer(self) -> None:
+        import livros.ambientes
+        if self.__renderizadores is None:
+            aquecer_renderizador()
+        else:
+            wait([self.__renderizadores.submit(aquecer_renderizador) for _ in range(self.__trabalhadores)])
+        if self.__motor != "local":
+            with self.__navegadores.emprestar():
+                pass
+
+    def encerrar(self) -> None:
+        self.__navegadores.fechar()
+        if self.__renderizadores is not None: self.__renderizadores.shutdown(cancel_futures = True)
+        if self.__assinatura is not None: barramento.cancelar(self.__assinatura)
+        if self.__saida_registro is not None: self.__saida_registro.fechar()
+
 class Livro:
 
-    def __init__(self, notify: Callable[[str], None], src_dir: Dir, dest_dir: Dir, book_name: File) -> None:
+    def __init__(
+            self,
+            notify: Callable[[str], None],
+            recursos: Recursos,
+            tempos: Tempos,
+            src_dir: Dir,
+            dest_dir: Dir,
+            book_name: File,
+            rastrear: bool = False,
+            motor: str | None = None
+    ) -> None:
         self.__input = book_name
         self.__temp = dest_dir.file(f"{book_name.local_name_no_extension}-temp.html")
         self.__output = dest_dir.file(f"{book_name.local_name_no_extension}.pdf")
         self.__src_dir = src_dir
         self.__notify = notify
+        self.__recursos = recursos
+        self.__tempos = tempos
+        self.__espera_javascript: float | None = None
+        self.__rastrear = rastrear
+        self.__dependencias: set[str] | None = None
+        self.__motor = recursos.motor if motor is None else motor
+
+    @property
+    def espera_javascript(self) -> float | None:
+        return self.__espera_javascript
+
+    @property
+    def output(self) -> File:
+        return self.__output
+
+    # Só é preenchido quando o livro é montado com rastrear. None significa que qualquer alteração pode afetá-lo.
+    @property
+    def dependencias(self) -> set[str] | None:
+        return self.__dependencias
 
     def assemble(self) -> None:
-        html_content1 = self.__render_jinja()
-        html_content2 = self.__process_javascript(html_content1)
-        self.__html_to_pdf(html_content2)
+        with self.__tempos.medir("jinja"):
+            html_content1 = self.__render_jinja()
+        if self.__rastrear: self.__rastrear_dependencias(html_content1)
+        cache = self.__recursos.cache
+        if cache is None:
+            html_content2 = self.__process_page(html_content1)
+            self.__html_to_pdf(html_content2)
+        else:
+            self.__assemble_com_cache(cache, html_content1)
         self.__notify(f"[{self.__output.local_name}] Pronto!")
 
+    def __assemble_com_cache(self, cache: CacheLivros, html_content1: str) -> None:
+        src_url = self.__src_dir.url
+        with self.__tempos.medir("cache"):
+            variante = ("" if self.__motor == "navegador" else self.__motor) + ("+partes" if self.__recursos.dividir else "")
+            chave = cache.chave(html_content1, self.__src_dir.absolute_name, src_url, variante)
+            acerto = cache.obter_pdf(chave, self.__output.absolute_name)
+        if acerto:
+            self.__notify(f"[{self.__output.local_name}] PDF recuperado do cache.")
+            return
+        html_content2 = cache.obter_html(chave, src_url)
+        if html_content2 is None:
+            html_content2 = self.__process_page(html_content1)
+            cache.guardar_html(chave, html_content2, src_url)
+        else:
+            self.__notify(f"[{self.__output.local_name}] HTML pós-JavaScript recuperado do cache.")
+        self.__html_to_pdf(html_content2)
+        cache.guardar_pdf(chave, self.__output.absolute_name)
+
     # Adaptado de https://stackoverflow.com/a/33944561/540552
     def __render_jinja(self) -> str:
         self.__notify(f"[{self.__output.local_name}] Montando o HTML do conteúdo...")
-        import jinja2
-        plugins = os.path.join(os.path.dirname(__file__), "plugins")
-        return jinja2.Environment(loader = jinja2.FileSystemLoader([self.__src_dir.absolute_name, plugins])) \
+        from livros.ambientes import ambiente_jinja
+        return ambiente_jinja(self.__src_dir.absolute_name) \
                 .get_template(self.__input.local_name) \
                 .render(dir_path = self.__src_dir.url)
 
+    # Os templates usados e os arquivos referenciados pelo HTML e pelos seus CSS. O que só o JavaScript carrega fica de fora.
+    def __rastrear_dependencias(self, html_content1: str) -> None:
+        from livros.ambientes import dependencias_jinja
+        templates = dependencias_jinja(self.__src_dir.absolute_name, self.__input.local_name)
+        if templates is None:
+            self.__dependencias = None
+            return
+        arquivos = livros.cache.dependencias(html_content1, self.__src_dir.absolute_name)
+        self.__dependencias = templates | arquivos | {livros.cache.normalizar(self.__input.absolute_name)}
+
     def __html_to_pdf(self, html_content_1: str) -> None:
+        if self.__recursos.dividir and len(html_content_1) >= 2 * livros.partes.tamanho_parte and self.__html_to_pdf_em_partes(html_content_1): return
         self.__notify(f"[{self.__output.local_name}] Gerando o PDF do conteúdo...")
-        import weasyprint
-        weasyprint.HTML(string = html_content_1) \
-                .render() \
-                .write_pdf(self.__output.absolute_name)
+        render, escrita, paginas = self.__recursos.gerar_pdf(html_content_1, self.__output, self.__src_dir.absolute_name)
+        self.__tempos.registrar("weasyprint_render", render)
+        self.__tempos.registrar("write_pdf", escrita)
+        self.__tempos.livro(paginas, os.path.getsize(self.__output.absolute_name))
+
+    # Divide o livro nos capítulos, renderiza as partes e junta os PDFs. Se o livro mostra números de página, as partes
+    # depois da primeira são renderizadas de novo, já sabendo em que página começam. Os links entre partes continuam
+    # funcionando, mas o target-counter e o counter(pages) só enxergam a própria parte, e as regras de @page :first
+    # valem para a primeira página de cada parte. Devolve False se o livro não puder ser dividido.
+    def __html_to_pdf_em_partes(self, html_content_1: str) -> bool:
+        try:
+            import pypdf # type: ignore[import-not-found, unused-ignore]
+        except ImportError:
+            self.__notify(f"[{self.__output.local_name}] O pypdf não está instalado. O livro não será dividido.")
+            return False
+        quantidade = max(self.__recursos.trabalhadores, math.ceil(len(html_content_1) / livros.partes.tamanho_parte))
+        partes = livros.partes.dividir(html_content_1, quantidade)
+        if partes is None:
+            self.__notify(f"[{self.__output.local_name}] Não há capítulos onde dividir o livro.")
+            return False
+        partes = livros.partes.ligar_ancoras(partes)
+        nome = self.__output.absolute_name[:-len(".pdf")]
+        arquivos = [File(f"{nome}-parte{i + 1}.pdf") for i in range(len(partes))]
+        try:
+            self.__notify(f"[{self.__output.local_name}] Gerando o PDF do conteúdo em {len(partes)} partes...")
+            resultados = self.__recursos.gerar_partes(list(zip(partes, arquivos)), self.__src_dir.absolute_name)
+            render = sum(r[0] for r in resultados)
+            escrita = sum(r[1] for r in resultados)
+            if livros.partes.usa_contador_de_pagina(html_content_1, self.__src_dir.absolute_name):
+                self.__notify(f"[{self.__output.local_name}] Numerando as páginas das partes...")
+                anteriores = [sum(r[2] for r in resultados[:i]) for i in range(len(resultados))]
+                refeitas = [(livros.partes.numerar(partes[i], anteriores[i]), arquivos[i]) for i in range(1, len(partes))]
+                resultados = resultados[:1] + self.__recursos.gerar_partes(refeitas, self.__src_dir.absolute_name)
+                render += sum(r[0] for r in resultados[1:])
+                escrita += sum(r[1] for r in resultados[1:])
+            self.__notify(f"[{self.__output.local_name}] Juntando as partes...")
+            with self.__tempos.medir("juntar_pdf"):
+                livros.partes.juntar([f.absolute_name for f in arquivos], [r[3] for r in resultados], self.__output.absolute_name)
+        finally:
+            for f in arquivos:
+                f.kill()
+        self.__tempos.registrar("weasyprint_render", render)
+        self.__tempos.registrar("write_pdf", escrita)
+        self.__tempos.livro(sum(r[2] for r in resultados), os.path.getsize(self.__output.absolute_name))
+        return True
+
+    def __process_page(self, html_content1: str) -> str:
+        if self.__motor == "navegador": return self.__process_javascript(html_content1)
+        self.__notify(f"[{self.__output.local_name}] Processando o HTML sem navegador...")
+        with self.__tempos.medir("motor_local"):
+            html_content2, pendencias = livros.motor.preparar(html_content1)
+        if not pendencias: return html_content2
+        if self.__motor == "auto":
+            self.__notify(f"[{self.__output.local_name}] Usando o navegador por causa de: {'; '.join(pendencias)}.")
+            return self.__process_javascript(html_content1)
+        self.__notify(f"[{self.__output.local_name}] Ignorado por falta de navegador: {'; '.join(pendencias)}.")
+        return html_content2
 
     def __process_javascript(self, html_content_2: str) -> str:
-        self.__notify(f"[{self.__output.local_name}] Iniciando o Selenium...")
-        from selenium import webdriver
+        self.__notify(f"[{self.__output.local_name}] Obtendo um navegador...")
         try:
             self.__temp.save(html_content_2)
-            driver = webdriver.Firefox() # type: ignore[no-untyped-call]
-            try:
+            inicio = time.monotonic()
+            with self.__recursos.navegadores.emprestar() as driver:
+                self.__tempos.registrar("navegador", time.monotonic() - inicio)
                 self.__notify(f"[{self.__output.local_name}] Abrindo a página HTML...")
-                driver.get(self.__temp.url)
+                with self.__tempos.medir("carregamento"):
+                    driver.get(self.__temp.url)
                 self.__notify(f"[{self.__output.local_name}] Aguardando o JavaScript...")
-                time.sleep(descanso_javascript)
+                espera, pronto = aguardar_javascript(driver)
+                self.__tempos.registrar("javascript", espera)
+                self.__espera_javascript = espera
+                if pronto:
+                    self.__notify(f"[{self.__output.local_name}] JavaScript concluído em {espera:.2f} s.")
+                else:
+                    self.__notify(f"[{self.__output.local_name}] JavaScript não sinalizou conclusão após {espera:.2f} s. Prosseguindo assim mesmo.")
                 self.__notify(f"[{self.__output.local_name}] Coletando o HTML resultante...")
                 e = driver.find_element("xpath", "//*")
                 return e.get_attribute("outerHTML")
-            finally:
-                driver.quit()
         finally:
             if not limpeza_preguicosa:
                 self.__notify(f"[{self.__output.local_name}] Limpando o HTML temporário...")
@@ -204,95 +609,264 @@ class Livro:
 class Pacote:
 
     @staticmethod
-    def criar_pacote_zip(notify: Callable[[str], None], src_file: File, dest: File | None) -> "Pacote":
+    def criar_pacote_zip(recursos: Recursos, src_file: File, dest: File | None, motor: str | None = None) -> "Pacote":
         if not src_file.exists: raise Exception(f"O arquivo {src_file.absolute_name} não existe.")
         if not src_file.local_name.endswith(".zip"): raise Exception(f"O arquivo {src_file.absolute_name} não é um arquivo ZIP.")
 
         temp_dir = Dir.temp()
         if dest is None: dest = src_file.parent.file(f"out-{src_file.local_name}")
         src_dir = temp_dir.subdir("src")
+        inicio = time.monotonic()
         src_file.extract_to(src_dir)
-        return Pacote(notify, src_dir, dest, temp_dir)
+        p = Pacote(recursos, src_dir, dest, temp_dir, motor)
+        p.tempos.registrar("extracao", time.monotonic() - inicio)
+        return p
 
     @staticmethod
-    def criar_pacote_dir(notify: Callable[[str], None], src_dir: Dir, dest: File | None) -> "Pacote":
+    def criar_pacote_dir(recursos: Recursos, src_dir: Dir, dest: File | None, motor: str | None = None) -> "Pacote":
         if not src_dir.exists: raise Exception(f"O diretório {src_dir.absolute_name} não existe.")
 
         temp_dir = Dir.temp()
         if dest is None: dest = src_dir.parent.file(f"out-{src_dir.local_name}.zip")
-        return Pacote(notify, src_dir, dest, temp_dir)
+        if recursos.imagens is None: return Pacote(recursos, src_dir, dest, temp_dir, motor)
+
+        # As imagens são otimizadas no lugar, e a pasta do autor não pode ser alterada.
+        copia = temp_dir.subdir("src")
+        inicio = time.monotonic()
+        shutil.copytree(src_dir.absolute_name, copia.absolute_name)
+        p = Pacote(recursos, copia, dest, temp_dir, motor)
+        p.tempos.registrar("extracao", time.monotonic() - inicio)
+        return p
 
     @staticmethod
-    def criar_pacote_unsaved(notify: Callable[[str], None], unsaved: UnsavedFile, dest: File | None) -> "Pacote":
+    def criar_pacote_unsaved(recursos: Recursos, unsaved: UnsavedFile, dest: File | None, motor: str | None = None) -> "Pacote":
         if not unsaved.local_name.endswith(".zip"): raise Exception(f"O arquivo {unsaved.local_name} não é um arquivo ZIP.")
 
         temp_dir = Dir.temp()
         if dest is None: dest = temp_dir.file(f"out-{unsaved.local_name}")
-        src_file = unsaved.save_to(temp_dir)
         src_dir = temp_dir.subdir("src")
-        src_file.extract_to(src_dir)
-        return Pacote(notify, src_dir, dest, temp_dir)
+        inicio = time.monotonic()
+        File.extract_stream_to(unsaved.stream, src_dir)
+        p = Pacote(recursos, src_dir, dest, temp_dir, motor)
+        p.tempos.registrar("extracao", time.monotonic() - inicio)
+        return p
 
-    def __init__(self, renotify: Callable[[str], None], src_dir: Dir, dest: File, temp_dir: Dir) -> None:
+    def __init__(self, recursos: Recursos, src_dir: Dir, dest: File, temp_dir: Dir, motor: str | None = None) -> None:
+        if motor is not None and motor not in motores: raise Exception(f"O motor deve ser um de {', '.join(motores)}, mas foi {motor}.")
+        self.__motor = motor
         self.__temp_dir = temp_dir
         self.__src_dir = src_dir
         self.__zip_out = dest
-        self.__renotify = renotify
+        self.__canal = f"pacote.{temp_dir.local_name}"
+        self.__recursos = recursos
+        self.__registro = recursos.registro
+        self.__tempos = Tempos(recursos.metricas)
 
         self.__lock = RLock()
-        self.__status: list[str] = []         # Mutável, guardado pelo lock.
+        self.__novidade = Condition(self.__lock)
+        self.__status: deque[str] = deque(maxlen = limite_status) # Mutável, guardado pelo lock.
+        self.__descartados = 0                                     # Mutável, guardado pelo lock. Linhas que saíram do status.
         self.__pronto: datetime | None = None # Mutável, guardado pelo lock.
+        self.__falha: str | None = None       # Mutável, guardado pelo lock.
+        self.__prontos: list[str] = []        # Mutável, guardado pelo lock.
+
+        # Com um registro, o estado do pacote é lido de lá, pois ele pode estar sendo montado por outro processo.
+        if self.__registro is not None:
+            self.__registro.registrar(self.nome, temp_dir.absolute_name, src_dir.absolute_name, dest.absolute_name, motor)
+
+        # O status é o que o pacote recebe do seu canal no barramento de eventos.
+        self.__assinatura = barramento.assinar(self.__receber, self.__canal, INFO)
 
     def assemble(self) -> None:
+        try:
+            with self.__tempos.medir("pacote"):
+                self.__assemble()
+        finally:
+            if self.__registro is not None:
+                with self.__lock:
+                    falha = self.__falha
+                # Quem vê o pacote concluído no registro lê o status uma última vez, e ele precisa estar completo.
+                self.__recursos.gravar_status()
+                self.__registro.concluir(self.nome, falha, self.__tempos.resumo)
+
+    def __assemble(self) -> None:
         self.__notify("Iniciando...")
         build_dir = self.__temp_dir.subdir("bld")
         try:
             build_dir.mkdir()
             src_dir_deep = self.__src_dir.single_child_down
-            for f in src_dir_deep.files("*.html"):
-                Livro(self.__notify, src_dir_deep, build_dir, f).assemble()
-            self.__notify("Zipando tudo...")
-            build_dir.zip_to(self.__zip_out)
+            otimizador = self.__recursos.imagens
+            if otimizador is not None: self.__otimizar_imagens(otimizador, src_dir_deep)
+            arquivos = sorted(src_dir_deep.files("*.html"), key = lambda f: f.local_name)
+            saida = ZipIncremental(self.__zip_out)
+            try:
+                self.__assemble_livros([Livro(self.__notify, self.__recursos, self.__tempos, src_dir_deep, build_dir, f, motor = self.__motor) for f in arquivos], saida)
+                self.__notify("Finalizando o ZIP...")
+            finally:
+                with self.__tempos.medir("zip"):
+                    saida.close()
+        except Exception as x:
+            self.__recursos.metricas.incrementar("livros_pacotes_total", 'resultado="falha"')
+            self.__notify(f"Falha: {x}", ERRO)
+            log_lock(self.nome, "falha")
+            with self.__lock:
+                log_lock(self.nome, "falha", True)
+                self.__falha = str(x)
+                self.__pronto = datetime.now()
+                self.__novidade.notify_all()
+            # O ZIP parcial pode estar aberto por um download em andamento, e no Windows não pode ser apagado ainda.
+            # Os ZIPs enviados ao servidor ficam na pasta do pacote, e o zelador os apaga junto com ela.
+            try:
+                self.__zip_out.kill()
+            except OSError as y:
+                self.__notify(f"Não foi possível apagar o ZIP parcial: {y}", AVISO)
+            raise
         finally:
             if not limpeza_preguicosa:
                 self.__notify("Limpando arquivos temporários...")
                 build_dir.kill()
                 self.__temp_dir.subdir("src").kill()
+        self.__recursos.metricas.incrementar("livros_pacotes_total", 'resultado="ok"')
         self.__notify("Fim!")
-        log_lock(f"[lock] {self.nome} (pronto)...")
+        log_lock(self.nome, "pronto")
         with self.__lock:
-            log_lock(f"[lock] {self.nome} (pronto) obtido.")
+            log_lock(self.nome, "pronto", True)
             self.__pronto = datetime.now()
-
-    def limpeza(self) -> bool:
-        if not self.old: return False
-        log_lock(f"[lock] {self.nome} (limpeza)...")
+            self.__novidade.notify_all()
+
+    def __otimizar_imagens(self, otimizador: OtimizadorImagens, src_dir: Dir) -> None:
+        self.__notify(f"Otimizando as imagens para {otimizador.dpi} DPI...")
+        with self.__tempos.medir("imagens"):
+            r = otimizador.otimizar(src_dir.absolute_name)
+        for k in ["imagens", "duplicadas", "reduzidas", "do_cache"]:
+            self.__recursos.metricas.incrementar("livros_imagens_total", f'tipo="{k}"', r[k])
+        self.__recursos.metricas.incrementar("livros_imagens_bytes_economizados_total", "", r["bytes_antes"] - r["bytes_depois"])
+        mb = 1024 * 1024
+        self.__notify(
+            f"{r['imagens']} imagens ({r['duplicadas']} duplicadas, {r['reduzidas']} reduzidas, {r['do_cache']} do cache): "
+            f"{r['bytes_antes'] / mb:.1f} MB -> {r['bytes_depois'] / mb:.1f} MB."
+        )
+
+    # Se algum livro falhar, os que ainda não começaram são cancelados e a falha relatada é a do primeiro livro
+    # com erro na ordem dos nomes. Como o executor inicia os livros na ordem de submissão, os cancelados vêm
+    # sempre depois de todos os que foram iniciados, e por isso o resultado não depende de quem terminou antes.
+    def __assemble_livros(self, livros: list[Livro], saida: ZipIncremental) -> None:
+        if self.__recursos.trabalhadores == 1 or len(livros) <= 1:
+            for livro in livros:
+                self.__assemble_livro(livro, saida)
+            return
+        with ThreadPoolExecutor(max_workers = self.__recursos.trabalhadores) as executor:
+            futuros: list[Future[None]] = [executor.submit(self.__assemble_livro, livro, saida) for livro in livros]
+            wait(futuros, return_when = FIRST_EXCEPTION)
+            for futuro in futuros:
+                futuro.cancel()
+        for futuro in futuros:
+            if not futuro.cancelled(): futuro.result()
+
+    # Cada livro vai para o ZIP assim que fica pronto, e pode ser baixado individualmente a partir daí.
+    def __assemble_livro(self, livro: Livro, saida: ZipIncremental) -> None:
+        livro.assemble()
+        with self.__tempos.medir("zip"):
+            saida.add(livro.output)
+        log_lock(self.nome, "livro pronto")
         with self.__lock:
-            log_lock(f"[lock] {self.nome} (limpeza) obtido.")
+            log_lock(self.nome, "livro pronto", True)
+            self.__prontos.append(livro.output.local_name)
+        if self.__registro is not None: self.__registro.livro_pronto(self.nome, livro.output.local_name, self.__tempos.resumo)
+        self.__notify(f"[{livro.output.local_name}] Disponível para download.")
+
+    # Enquanto o pacote está sendo montado, o PDF é lido da pasta de build. Depois disso, ele só existe dentro do ZIP,
+    # e é extraído uma vez para a pasta pdf do pacote, para ser enviado como arquivo, com tamanho e Range.
+    def caminho_livro(self, nome: str) -> str | None:
+        if nome not in self.prontos: return None
+        construido = self.__temp_dir.subdir("bld").file(nome)
+        if construido.exists: return construido.absolute_name
+        pasta = self.__temp_dir.subdir("pdf")
+        extraido = pasta.file(nome)
+        if extraido.exists: return extraido.absolute_name
+        import zipfile
+        os.makedirs(pasta.absolute_name, exist_ok = True)
+        temp = f"{extraido.absolute_name}.{current_thread().ident}.tmp"
+        try:
+            with zipfile.ZipFile(self.__zip_out.absolute_name, "r") as zf, zf.open(nome) as origem, open(temp, "wb") as destino:
+                shutil.copyfileobj(origem, destino, 1024 * 1024)
+        except (FileNotFoundError, KeyError):
+            # O pacote falhou (ou expirou) depois da consulta aos prontos, e o ZIP já foi apagado.
+            return None
+        os.replace(temp, extraido.absolute_name)
+        return extraido.absolute_name
+
+    def descartar(self) -> None:
+        log_lock(self.nome, "limpeza")
+        with self.__lock:
+            log_lock(self.nome, "limpeza", True)
+            barramento.cancelar(self.__assinatura)
+            if self.__registro is not None: self.__registro.remover(self.nome)
             self.__temp_dir.kill()
-            return True
 
-    def __notify(self, txt: str) -> None:
-        log_lock(f"[lock] {self.nome} (notify)...")
-        with self.__lock:
-            log_lock(f"[lock] {self.nome} (notify) obtido.")
-            self.__status.append(txt)
-        self.__renotify(f"[{self.__temp_dir.local_name}] {txt}")
+    # Só cancela a assinatura do barramento, sem apagar nada. Serve para os pacotes que outro processo já apagou.
+    def soltar(self) -> None:
+        barramento.cancelar(self.__assinatura)
 
-    @property
-    def status(self) -> list[str]:
-        log_lock(f"[lock] {self.nome} (status)...")
+    def __notify(self, txt: str, nivel: int = INFO) -> None:
+        barramento.publicar(nivel, self.__canal, txt)
+
+    def __receber(self, evento: Evento) -> None:
+        log_lock(self.nome, "notify")
         with self.__lock:
-            log_lock(f"[lock] {self.nome} (status) obtido.")
-            return self.__status[:]
+            log_lock(self.nome, "notify", True)
+            if len(self.__status) == self.__status.maxlen: self.__descartados += 1
+            self.__status.append(evento.mensagem)
+            self.__novidade.notify_all()
+
+    # O cursor conta todas as linhas já emitidas, inclusive as que não cabem mais no status.
+    # Devolve o cursor a ser usado na próxima chamada e as linhas novas desde o cursor dado.
+    def status_desde(self, cursor: int) -> tuple[int, list[str]]:
+        if self.__registro is not None: return self.__registro.status_desde(self.nome, cursor)
+        log_lock(self.nome, "status desde")
+        with self.__lock:
+            log_lock(self.nome, "status desde", True)
+            inicio = max(cursor - self.__descartados, 0)
+            return self.__descartados + len(self.__status), list(islice(self.__status, inicio, None))
+
+    # Como status_desde, mas se não houver nada novo, espera até que haja ou até que o pacote termine.
+    def aguardar_status(self, cursor: int, timeout: float) -> tuple[int, list[str]]:
+        if self.__registro is not None: return self.__registro.aguardar_status(self.nome, cursor, timeout)
+        log_lock(self.nome, "aguardar status")
+        with self.__lock:
+            log_lock(self.nome, "aguardar status", True)
+            self.__novidade.wait_for(lambda: self.__descartados + len(self.__status) > cursor or self.__pronto is not None, timeout)
+            return self.status_desde(cursor)
 
     @property
     def pronto(self) -> datetime | None:
-        log_lock(f"[lock] {self.nome} (pronto)...")
+        if self.__registro is not None:
+            pronto = self.__registro.situacao(self.nome)[0]
+            return None if pronto is None else datetime.fromtimestamp(pronto)
+        log_lock(self.nome, "pronto")
         with self.__lock:
-            log_lock(f"[lock] {self.nome} (pronto) obtido.")
+            log_lock(self.nome, "pronto", True)
             return self.__pronto
 
+    # Se o pacote falhar, os livros que ficaram prontos antes se perdem junto com o ZIP parcial.
+    @property
+    def prontos(self) -> list[str]:
+        if self.__registro is not None:
+            _, falha, prontos, _ = self.__registro.situacao(self.nome)
+            return [] if falha is not None else prontos
+        log_lock(self.nome, "prontos")
+        with self.__lock:
+            log_lock(self.nome, "prontos", True)
+            return [] if self.__falha is not None else self.__prontos[:]
+
+    @property
+    def falha(self) -> str | None:
+        if self.__registro is not None: return self.__registro.situacao(self.nome)[1]
+        log_lock(self.nome, "falha")
+        with self.__lock:
+            log_lock(self.nome, "falha", True)
+            return self.__falha
+
     @property
     def out_file(self) -> File:
         return self.__zip_out
@@ -302,26 +876,74 @@ class Pacote:
         return self.__temp_dir.local_name
 
     @property
-    def old(self) -> bool:
-        p = self.pronto
-        return p is not None and p - datetime.now() > timedelta(hours = 1)
+    def tempos(self) -> Tempos:
+        return self.__tempos
+
+    # O resumo dos tempos de onde quer que o pacote esteja sendo montado.
+    @property
+    def resumo_tempos(self) -> dict[str, object]:
+        if self.__registro is not None: return self.__registro.situacao(self.nome)[3]
+        return self.__tempos.resumo
+
+    @property
+    def temp_dir(self) -> Dir:
+        return self.__temp_dir
 
 class Biblioteca:
 
-    def __init__(self, notify: Callable[[str], None], iniciar_zelador: bool) -> None:
-        Biblioteca.__import_dlls()
-        self.__notify = notify
+    def __init__(
+            self,
+            notify: Callable[[str], None],
+            iniciar_zelador: bool,
+            navegadores: int = livros.navegador.tamanho_pool,
+            trabalhadores: int = 1,
+            limite_cache: int = livros.cache.limite_cache,
+            pacotes_simultaneos: int = livros.agendador.pacotes_simultaneos,
+            tamanho_fila: int = livros.agendador.tamanho_fila,
+            cota: int = cota_temp,
+            abrir_navegador: Callable[[], "WebDriver"] = abrir_firefox,
+            limite_weasyprint: int = livros.renderizacao.limite_weasyprint,
+            motor: str = motor_padrao,
+            dpi_imagens: int = 0,
+            registro: Registro | None = None,
+            dividir: bool = False
+    ) -> None:
+        import_dlls()
+        # O notify recebe, numa thread própria, os eventos do barramento a partir do nível INFO.
+        self.__saida = SaidaTexto(notify)
+        self.__assinatura = barramento.assinar(self.__saida, "", INFO)
+        self.__recursos = Recursos(navegadores, trabalhadores, limite_cache, abrir_navegador, limite_weasyprint, motor, dpi_imagens, registro, dividir)
+        self.__agendador = Agendador(pacotes_simultaneos, tamanho_fila)
+        self.__pacotes_simultaneos = pacotes_simultaneos
+        self.__tamanho_fila = tamanho_fila
+        self.__registro = registro
         self.__lock = RLock()
-        self.__pacotes: dict[str, Pacote] = {} # Mutável, guardado pelo lock.
-        self.__zelador: Zelador | None = None  # Mutável, guardado pelo lock.
+        self.__pacotes: dict[str, Pacote] = {}      # Mutável, guardado pelo lock.
+        self.__por_conteudo: dict[str, Pacote] = {} # Mutável, guardado pelo lock. Pacotes enviados, pelo hash e motor.
+        self.__agendados: set[str] = set()          # Mutável, guardado pelo lock.
+        self.__zelador: Zelador | None = None       # Mutável, guardado pelo lock.
 
         if iniciar_zelador:
             log_zelador(f"[Zelador] Iniciando o zelador...")
-            self.__zelador = Zelador(self.__lock, self.__pacotes)
+            if registro is None:
+                self.__zelador = Zelador(self.__lock, self.__pacotes, cota)
+            else:
+                self.__zelador = Zelador(self.__lock, self.__pacotes, cota, registro.nomes, carencia_orfaos)
         else:
             log_zelador(f"[Zelador] Zelador desativado.")
 
-    def criar_pacote_zip_ou_dir(self, src: str, dest: File | None) -> Pacote:
+        # Com um registro, a fila é a dele, e os pacotes são reivindicados de lá por este e pelos demais processos.
+        if registro is not None:
+            dono = f"{socket.gethostname()}:{os.getpid()}"
+            for i in range(pacotes_simultaneos):
+                t = Thread(target = self.__trabalhar, args = (dono,), name = f"registro-{i + 1}")
+                t.daemon = True
+                t.start()
+            t = Thread(target = self.__pulsar, args = (dono,), name = "registro-batimento")
+            t.daemon = True
+            t.start()
+
+    def criar_pacote_zip_ou_dir(self, src: str, dest: File | None, motor: str | None = None) -> Pacote:
         f = File(src)
         d = Dir(src)
         if not f.exists and not d.exists:
@@ -329,66 +951,326 @@ class Biblioteca:
         if f.exists and d.exists:
             raise Exception(f"A pasta {d.absolute_name} existe e o arquivo {f.absolute_name} também. Só pode-se trabalhar com um deles.")
         if f.exists:
-            return self.criar_pacote_zip(f, dest)
-        return self.criar_pacote_dir(d, dest)
-
-    def criar_pacote_zip(self, src_file: File, dest: File | None) -> Pacote:
-        return self.__criar_pacote(lambda: Pacote.criar_pacote_zip(self.__notify, src_file, dest))
-
-    def criar_pacote_dir(self, src_dir: Dir, dest: File | None) -> Pacote:
-        return self.__criar_pacote(lambda: Pacote.criar_pacote_dir(self.__notify, src_dir, dest))
+            return self.criar_pacote_zip(f, dest, motor)
+        return self.criar_pacote_dir(d, dest, motor)
+
+    def criar_pacote_zip(self, src_file: File, dest: File | None, motor: str | None = None) -> Pacote:
+        return self.__criar_pacote(lambda: Pacote.criar_pacote_zip(self.__recursos, src_file, dest, motor))
+
+    def criar_pacote_dir(self, src_dir: Dir, dest: File | None, motor: str | None = None) -> Pacote:
+        return self.__criar_pacote(lambda: Pacote.criar_pacote_dir(self.__recursos, src_dir, dest, motor))
+
+    # Envios idênticos (mesmo conteúdo e mesmo motor) compartilham o mesmo pacote enquanto ele estiver sendo montado ou
+    # até que o zelador o apague. Um pacote que falhou não é reaproveitado. Como os pacotes são criados com o lock da
+    # biblioteca obtido, dois envios idênticos simultâneos também resultam num pacote só.
+    # Se ele pode ser reaproveitado é verificado sem o lock, pois com um registro isso consulta o SQLite. Um pacote
+    # criado por outro envio idêntico enquanto isso acabou de ser criado, e é reaproveitado sem verificar.
+    # Com um cliente, lança FilaCheia se ele não puder enviar mais pacotes agora. Um envio idêntico a um pacote que
+    # ainda existe é sempre aceito, pois só reaproveita aquele pacote, sem entrar na fila.
+    def criar_pacote_unsaved(self, unsaved: UnsavedFile, dest: File | None, motor: str | None = None, cliente: str | None = None) -> Pacote:
+        if dest is not None:
+            if cliente is not None: self.verificar_fila(cliente)
+            return self.__criar_pacote(lambda: Pacote.criar_pacote_unsaved(self.__recursos, unsaved, dest, motor))
+        chave = f"{unsaved.sha256()}:{motor or self.__recursos.motor}"
+        log_lock("pacote", "envio")
+        with self.__lock:
+            log_lock("pacote", "envio", True)
+            candidato = self.__por_conteudo.get(chave)
+            if candidato is not None and self.__pacotes.get(candidato.nome) is not candidato: candidato = None
+        reaproveitavel = candidato is not None and self.__reaproveitavel(candidato)
+        with self.__lock:
+            log_lock("pacote", "envio", True)
+            p = self.__por_conteudo.get(chave)
+            if p is not None and self.__pacotes.get(p.nome) is p and (p is not candidato or reaproveitavel):
+                zelador = self.__zelador
+                self.__recursos.metricas.incrementar("livros_envios_total", 'resultado="reaproveitado"')
+            else:
+                if cliente is not None: self.verificar_fila(cliente)
+                p = self.__criar_pacote(lambda: Pacote.criar_pacote_unsaved(self.__recursos, unsaved, None, motor))
+                for k in [k for k, q in self.__por_conteudo.items() if self.__pacotes.get(q.nome) is not q]:
+                    del self.__por_conteudo[k]
+                self.__por_conteudo[chave] = p
+                self.__recursos.metricas.incrementar("livros_envios_total", 'resultado="novo"')
+                return p
+        if zelador is not None: zelador.tocar(p)
+        return p
 
-    def criar_pacote_unsaved(self, unsaved: UnsavedFile, dest: File | None) -> Pacote:
-        return self.__criar_pacote(lambda: Pacote.criar_pacote_unsaved(self.__notify, unsaved, dest))
+    # Com um registro, o pacote pode ter sido apagado por outro processo sem que este saiba, e nesse caso a falha,
+    # lida do registro, aparece como None.
+    def __reaproveitavel(self, p: Pacote) -> bool:
+        if self.__registro is not None and self.__registro.localizar(p.nome) is None: return False
+        return p.falha is None and p.temp_dir.exists
 
     def __criar_pacote(self, ctor: Callable[[], Pacote]) -> Pacote:
-        log_lock(f"[lock] pacote (criação)...")
+        log_lock("pacote", "criação")
         with self.__lock:
-            log_lock(f"[lock] pacote (criação) obtido.")
+            log_lock("pacote", "criação", True)
             p = ctor()
             self.__pacotes[p.nome] = p
         return p
 
     def localizar_pacote(self, arq: str) -> Pacote | None:
-        log_lock(f"[lock] pacote (localização)...")
+        log_lock("pacote", "localização")
         with self.__lock:
-            log_lock(f"[lock] pacote (localização) obtido.")
-            return self.__pacotes.get(arq, None)
+            log_lock("pacote", "localização", True)
+            p = self.__pacotes.get(arq, None)
+            zelador = self.__zelador
+        if self.__registro is not None: p = self.__localizar_registrado(self.__registro, arq, p)
+        if p is not None and zelador is not None: zelador.tocar(p)
+        return p
 
-    @staticmethod
-    def __import_dlls() -> None:
-        import ctypes
-        dll_path = r"C:\Program Files\GTK3-Runtime Win64\bin"
-        for dll in ["gobject-2.0-0", "pango-1.0-0", "fontconfig-1", "pangoft2-1.0-0"]:
-            ctypes.WinDLL(dll_path + f"\\lib{dll}.dll")
+    # O pacote pode ter sido criado ou descartado por outro processo. Os criados por outros processos
+    # ganham aqui um objeto Pacote próprio, que lê o estado do registro. Os descartados por outros processos já tiveram
+    # a pasta apagada, então aqui o objeto só é solto. O zelador faz o mesmo com os que não forem mais procurados.
+    def __localizar_registrado(self, registro: Registro, arq: str, p: Pacote | None) -> Pacote | None:
+        r = registro.localizar(arq)
+        if r is None:
+            if p is not None:
+                with self.__lock:
+                    if self.__pacotes.get(arq) is p: del self.__pacotes[arq]
+                p.soltar()
+            return None
+        if p is not None: return p
+        temp_dir, src_dir, saida, motor = r
+        return self.__criar_pacote(lambda: Pacote(self.__recursos, Dir(src_dir), File(saida), Dir(temp_dir), motor))
+
+    def __trabalhar(self, dono: str) -> None:
+        registro = self.__registro
+        assert registro is not None
+        while True:
+            try:
+                nome = registro.reivindicar(dono)
+                p = None if nome is None else self.localizar_pacote(nome)
+            except Exception:
+                traceback.print_exc()
+                p = None
+            if p is None:
+                time.sleep(livros.registro.intervalo_registro)
+                continue
+            try:
+                self.__assemble(p)
+            except Exception:
+                traceback.print_exc()
+
+    # Renova o batimento dos pacotes montados por este processo e conclui com falha os abandonados por processos que
+    # morreram, que passam a ser apagados pelo zelador deste processo quando expirarem.
+    def __pulsar(self, dono: str) -> None:
+        registro = self.__registro
+        assert registro is not None
+        while True:
+            time.sleep(livros.registro.intervalo_batimento)
+            try:
+                registro.pulsar(dono)
+                abandonados = registro.recuperar(livros.registro.limite_batimento, "O processo que montava o pacote parou de responder.")
+                with self.__lock:
+                    zelador = self.__zelador
+                for nome in abandonados:
+                    p = self.localizar_pacote(nome)
+                    if p is not None and zelador is not None: zelador.concluido(p)
+            except Exception:
+                traceback.print_exc()
+
+    # Lança FilaCheia se o cliente não puder enviar mais pacotes agora. Serve para recusar um upload antes de salvá-lo.
+    def verificar_fila(self, cliente: str) -> None:
+        if self.__registro is None:
+            self.__agendador.verificar(cliente)
+        else:
+            self.__registro.verificar(cliente, self.__tamanho_fila, livros.agendador.fila_por_cliente, self.__pacotes_simultaneos)
+
+    # Não faz nada se o pacote já tiver sido agendado, como acontece com os envios idênticos.
+    def agendar(self, p: Pacote, cliente: str) -> None:
+        log_lock("pacote", "agendamento")
+        with self.__lock:
+            log_lock("pacote", "agendamento", True)
+            if p.nome in self.__agendados: return
+            self.__agendados.intersection_update(self.__pacotes.keys())
+            self.__agendados.add(p.nome)
+        try:
+            if self.__registro is None:
+                self.__agendador.submeter(cliente, p.nome, lambda: self.__assemble(p))
+            else:
+                self.__registro.enfileirar(p.nome, cliente, self.__tamanho_fila, livros.agendador.fila_por_cliente, self.__pacotes_simultaneos)
+        except FilaCheia:
+            self.descartar_pacote(p)
+            raise
+
+    def __assemble(self, p: Pacote) -> None:
+        try:
+            p.assemble()
+        finally:
+            with self.__lock:
+                zelador = self.__zelador
+            if zelador is not None: zelador.concluido(p)
+
+    def posicao_na_fila(self, p: Pacote) -> int | None:
+        if self.__registro is not None: return self.__registro.posicao(p.nome)
+        return self.__agendador.posicao(p.nome)
+
+    @property
+    def estatisticas_fila(self) -> dict[str, int]:
+        if self.__registro is None: return self.__agendador.estatisticas
+        return {**self.__registro.estatisticas, "trabalhadores": self.__pacotes_simultaneos, "tamanho_fila": self.__tamanho_fila}
 
+    def descartar_pacote(self, p: Pacote) -> None:
+        log_lock("pacote", "descarte")
+        with self.__lock:
+            log_lock("pacote", "descarte", True)
+            self.__pacotes.pop(p.nome, None)
+            self.__agendados.discard(p.nome)
+        p.descartar()
+
+    @property
+    def zelador(self) -> "Zelador | None":
+        log_lock("pacote", "zelador")
+        with self.__lock:
+            log_lock("pacote", "zelador", True)
+            return self.__zelador
+
+    @property
+    def agendador(self) -> Agendador:
+        return self.__agendador
+
+    @property
+    def recursos(self) -> Recursos:
+        return self.__recursos
+
+    def encerrar(self) -> None:
+        self.__recursos.encerrar()
+        barramento.cancelar(self.__assinatura)
+        self.__saida.fechar()
+
+# O zelador apaga os pacotes concluídos quando eles expiram (validade_pacote depois de prontos) e também os
+# menos acessados recentemente quando a pasta temp passa da cota. Os prazos ficam num heap, de forma que ele só
+# acorda quando algum prazo vence, quando algum pacote termina ou, no máximo, a cada descanso_zelador segundos.
+# Arquivos e pastas em temp que não pertencem a nenhum pacote também são apagados.
+# O lock da biblioteca só é usado para retirar os pacotes do dicionário. Apagar os arquivos é feito fora dele.
 class Zelador:
 
-    def __init__(self, lock: RLock, pacotes: dict[str, Pacote]) -> None:
+    def __init__(
+            self,
+            lock: RLock,
+            pacotes: dict[str, Pacote],
+            cota: int = cota_temp,
+            conhecidos: Callable[[], set[str]] | None = None,
+            carencia: float = 0
+    ) -> None:
         self.__lock = lock
         self.__pacotes = pacotes
+        self.__cota = cota
+        self.__conhecidos = conhecidos
+        self.__carencia = carencia
+        self.__condicao = Condition()
+        self.__prazos: list[tuple[float, str]] = []                # Mutável, guardado pela condição. Heap.
+        self.__concluidos: OrderedDict[str, Pacote] = OrderedDict() # Mutável, guardado pela condição. Do menos para o mais acessado.
+        self.__expirados = 0                                        # Mutável, guardado pela condição.
+        self.__despejados = 0                                       # Mutável, guardado pela condição.
+        self.__orfaos = 0                                           # Mutável, guardado pela condição.
+        self.__varreduras = 0                                       # Mutável, guardado pela condição.
+        self.__em_uso = 0                                           # Mutável, guardado pela condição.
         executor = Thread(target = self.limpar, args = ())
         executor.daemon = True
         executor.start()
 
+    def concluido(self, p: Pacote) -> None:
+        with self.__condicao:
+            heapq.heappush(self.__prazos, (time.time() + validade_pacote.total_seconds(), p.nome))
+            self.__concluidos[p.nome] = p
+            self.__condicao.notify()
+
+    def tocar(self, p: Pacote) -> None:
+        with self.__condicao:
+            if p.nome in self.__concluidos: self.__concluidos.move_to_end(p.nome)
+
+    @property
+    def estatisticas(self) -> dict[str, int]:
+        with self.__condicao:
+            return {
+                "pacotes_concluidos": len(self.__concluidos),
+                "pacotes_expirados": self.__expirados,
+                "pacotes_despejados": self.__despejados,
+                "orfaos_removidos": self.__orfaos,
+                "varreduras": self.__varreduras,
+                "bytes_em_uso": self.__em_uso,
+                "cota": self.__cota,
+            }
+
     def limpar(self) -> None:
         while True:
-            log_lock(f"[lock] pacote (zelador limpeza)...")
+            with self.__condicao:
+                proximo = self.__prazos[0][0] if self.__prazos else math.inf
+                espera = min(proximo - time.time(), descanso_zelador)
+                if espera > 0: self.__condicao.wait(espera)
+                vencidos = []
+                while self.__prazos and self.__prazos[0][0] <= time.time():
+                    _, nome = heapq.heappop(self.__prazos)
+                    if nome in self.__concluidos: vencidos.append(self.__concluidos.pop(nome))
+                self.__expirados += len(vencidos)
+                self.__varreduras += 1
+            for p in vencidos:
+                log_zelador(f"[Zelador] Eliminando o pacote expirado {p.nome}")
+                self.__remover(p)
+            self.__remover_orfaos()
+            self.__aplicar_cota()
+
+    def __remover(self, p: Pacote) -> None:
+        log_lock("pacote", "zelador remoção")
+        with self.__lock:
+            log_lock("pacote", "zelador remoção", True)
+            self.__pacotes.pop(p.nome, None)
+        p.descartar()
+
+    # Só pacotes concluídos são despejados. Os que estão na fila ou sendo montados nunca são tocados.
+    def __aplicar_cota(self) -> None:
+        temp = Dir("temp")
+        em_uso = temp.size
+        while em_uso > self.__cota:
+            with self.__condicao:
+                if not self.__concluidos: break
+                _, p = self.__concluidos.popitem(last = False)
+                self.__despejados += 1
+            tamanho = p.temp_dir.size
+            log_zelador(f"[Zelador] Cota de {self.__cota} bytes excedida ({em_uso} bytes). Eliminando o pacote {p.nome}")
+            self.__remover(p)
+            em_uso -= tamanho
+        with self.__condicao:
+            self.__em_uso = em_uso
+
+    # A pasta temp é listada antes de se consultar os pacotes existentes. Como os pacotes são criados e registrados
+    # com o lock da biblioteca obtido, qualquer pasta listada que não esteja registrada logo depois é de fato órfã.
+    # Isso não vale para os pacotes conhecidos por outros processos, que são criados sem o nosso lock, e por isso
+    # uma pasta só é considerada órfã se não tiver sido modificada há pelo menos carencia segundos.
+    # Pela mesma ordem, um pacote deste processo que não está mais entre os conhecidos foi apagado por outro processo,
+    # e o seu objeto é solto.
+    def __remover_orfaos(self) -> None:
+        temp = Dir("temp")
+        arquivos = temp.files()
+        pastas = temp.subdirs()
+        log_lock("pacote", "zelador órfãos")
+        with self.__lock:
+            log_lock("pacote", "zelador órfãos", True)
+            locais = dict(self.__pacotes)
+        nomes = set(locais.keys())
+        if self.__conhecidos is not None:
+            conhecidos = self.__conhecidos()
+            esquecidos = [p for n, p in locais.items() if n not in conhecidos]
             with self.__lock:
-                log_lock(f"[lock] pacote (zelador limpeza) obtido.")
-                for k, v in self.__pacotes.items():
-                    log_zelador(f"[Zelador] Olhando o pacote {k}")
-                    if v.limpeza():
-                        log_zelador(f"[Zelador] Eliminado pacote antigo {k}")
-                        del self.__pacotes[k]
-                for f in Dir("temp").files():
-                    log_zelador(f"[Zelador] Olhando o arquivo {f.absolute_name}")
-                    if f.local_name != "README.md" and f.local_name not in self.__pacotes:
-                        log_zelador(f"[Zelador] Eliminando o arquivo {f.absolute_name}")
-                        f.kill()
-                for d in Dir("temp").subdirs():
-                    log_zelador(f"[Zelador] Olhando o diretório {d.absolute_name}")
-                    if d.local_name not in self.__pacotes:
-                        log_zelador(f"[Zelador] Eliminando o diretório {d.absolute_name}")
-                        d.kill()
-            time.sleep(descanso_zelador)
\ No newline at end of file
+                for p in esquecidos:
+                    if self.__pacotes.get(p.nome) is p: del self.__pacotes[p.nome]
+            for p in esquecidos:
+                p.soltar()
+            nomes |= conhecidos
+        limite = time.time() - self.__carencia
+        orfaos: list[DirOrFile] = [f for f in arquivos if f.local_name != "README.md" and Zelador.__antigo(f, limite)]
+        orfaos += [d for d in pastas if d.local_name not in nomes and Zelador.__antigo(d, limite)]
+        for x in orfaos:
+            log_zelador(f"[Zelador] Eliminando {x.absolute_name}")
+            x.kill()
+        with self.__condicao:
+            self.__orfaos += len(orfaos)
+
+    @staticmethod
+    def __antigo(x: DirOrFile, limite: float) -> bool:
+        try:
+            return os.path.getmtime(x.absolute_name) < limite
+        except OSError:
+            return False
\ No newline at end of file
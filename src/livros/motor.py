@@ -0,0 +1,118 @@
+import livros
+import base64, html, re
+
+# Como o JavaScript das páginas é processado antes do WeasyPrint:
+# * navegador: tudo passa pelo Firefox, como sempre foi.
+# * local: nada passa pelo navegador. O highlight.js e o MathJax são substituídos pelo Pygments e pelo ziamath,
+#   e os demais scripts são ignorados.
+# * auto: como o local, mas as páginas com algo que só o navegador sabe fazer vão para o navegador.
+motores = ["navegador", "local", "auto"]
+motor_padrao = "navegador"
+
+estilo_codigo = "vs" # O mesmo tema do plugins/highlight.html.
+tamanho_formula = 16
+
+script = re.compile(r"<script\b([^>]*)>(.*?)</script\s*>", re.IGNORECASE | re.DOTALL)
+tipo_script = re.compile(r"""\btype\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+src_script = re.compile(r"""\bsrc\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+bloco_codigo = re.compile(r"(<pre\b[^>]*>\s*)<code\b([^>]*)>(.*?)</code\s*>", re.IGNORECASE | re.DOTALL)
+classe = re.compile(r"""\bclass\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+linguagem = re.compile(r"\b(?:language|lang)-([\w+#.-]+)")
+tag = re.compile(r"<[^>]+>")
+
+# Os elementos cujo conteúdo o MathJax não processa, seguidos das fórmulas nos delimitadores do plugins/mathjax.html.
+fora_das_formulas = re.compile(r"<(script|noscript|style|textarea|pre|code)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+formula = re.compile(r"\$\[(.+?)\]\$|\$\$(.+?)\$\$|\\\[(.+?)\\\]", re.DOTALL)
+config_mathjax = "inlineMath: [['$[', ']$']]"
+
+tipos_executaveis = ["", "text/javascript", "application/javascript", "module"]
+
+# Devolve o que o script faz, se for um dos que o motor local sabe substituir ou que podem ser ignorados sem prejuízo.
+def classificar_script(atributos: str, conteudo: str) -> str | None:
+    t = tipo_script.search(atributos)
+    if t is not None and t.group(1).lower() not in tipos_executaveis: return "inerte"
+    s = src_script.search(atributos)
+    src = "" if s is None else s.group(1).lower()
+    texto = " ".join(conteudo.split())
+    if re.search(r"highlight(\.min)?\.js$", src) or texto == "hljs.highlightAll();": return "highlight"
+    if "mathjax" in src: return "mathjax"
+    if src == "" and texto.startswith("MathJax =") and config_mathjax in texto: return "mathjax"
+    if "polyfill.io" in src: return "inerte"
+    return None
+
+# Faz sem navegador o que o JavaScript faria. Devolve o HTML resultante e, para cada coisa que ficou por fazer
+# (um script desconhecido, uma dependência que não está instalada, uma fórmula que não pôde ser convertida),
+# uma descrição. Se a lista estiver vazia, o resultado é equivalente ao do navegador.
+def preparar(html_content: str) -> tuple[str, list[str]]:
+    pendencias: list[str] = []
+    usados: set[str] = set()
+    for m in script.finditer(html_content):
+        tipo = classificar_script(m.group(1), m.group(2))
+        if tipo is None:
+            s = src_script.search(m.group(1))
+            pendencias.append(f"script {s.group(1) if s is not None else 'embutido'}")
+        else:
+            usados.add(tipo)
+    if "highlight" in usados: html_content = realcar_codigo(html_content, pendencias)
+    if "mathjax" in usados: html_content = converter_formulas(html_content, pendencias)
+    return html_content, pendencias
+
+def realcar_codigo(html_content: str, pendencias: list[str]) -> str:
+    try:
+        from pygments import highlight # type: ignore[import-untyped, import-not-found, unused-ignore]
+        from pygments.formatters import HtmlFormatter # type: ignore[import-untyped, import-not-found, unused-ignore]
+        from pygments.lexers import get_lexer_by_name, guess_lexer # type: ignore[import-untyped, import-not-found, unused-ignore]
+        from pygments.util import ClassNotFound # type: ignore[import-untyped, import-not-found, unused-ignore]
+    except ImportError:
+        if bloco_codigo.search(html_content) is not None: pendencias.append("highlight (Pygments não instalado)")
+        return html_content
+    formatador = HtmlFormatter(nowrap = True, noclasses = True, style = estilo_codigo)
+
+    def realcar(m: re.Match[str]) -> str:
+        atributos = m.group(2)
+        c = classe.search(atributos)
+        classes = "" if c is None else c.group(1)
+        if "hljs" in classes.split() or "nohighlight" in classes.split(): return m.group(0)
+        codigo = html.unescape(tag.sub("", m.group(3)))
+        n = linguagem.search(classes)
+        try:
+            lexer = get_lexer_by_name(n.group(1), ensurenl = False) if n is not None else guess_lexer(codigo, ensurenl = False)
+        except ClassNotFound:
+            lexer = guess_lexer(codigo, ensurenl = False)
+        if c is None:
+            atributos += ' class="hljs"'
+        else:
+            atributos = atributos[:c.start(1)] + f"hljs {classes}" + atributos[c.end(1):]
+        realcado = highlight(codigo, lexer, formatador)
+        if not codigo.endswith("\n"): realcado = realcado.rstrip("\n")
+        return f"{m.group(1)}<code{atributos}>{realcado}</code>"
+
+    return bloco_codigo.sub(realcar, html_content)
+
+def converter_formulas(html_content: str, pendencias: list[str]) -> str:
+    try:
+        from ziamath.zmath import Latex # type: ignore[import-not-found, unused-ignore]
+    except ImportError:
+        if formula.search(html_content) is not None: pendencias.append("MathJax (ziamath não instalado)")
+        return html_content
+
+    def converter(m: re.Match[str]) -> str:
+        inline = m.group(1) is not None
+        tex = html.unescape(m.group(1) if inline else m.group(2) or m.group(3))
+        try:
+            svg = Latex(tex, size = tamanho_formula).svg()
+        except Exception as x:
+            pendencias.append(f"fórmula {tex.strip()[:40]!r} ({x})")
+            return m.group(0)
+        img = f'<img class="livros-formula" style="vertical-align: middle;" src="data:image/svg+xml;base64,{base64.b64encode(svg.encode("utf-8")).decode("ascii")}">'
+        if inline: return img
+        return f'<div class="livros-formula-bloco" style="text-align: center; margin: 1em 0;">{img}</div>'
+
+    partes: list[str] = []
+    inicio = 0
+    for m in fora_das_formulas.finditer(html_content):
+        partes.append(formula.sub(converter, html_content[inicio:m.start()]))
+        partes.append(m.group(0))
+        inicio = m.end()
+    partes.append(formula.sub(converter, html_content[inicio:]))
+    return "".join(partes)
\ No newline at end of file
@@ -0,0 +1,193 @@
+import livros
+from livros.eventos import DEPURACAO, barramento
+from typing import Callable, Iterator, TYPE_CHECKING
+from contextlib import contextmanager
+from threading import Condition
+import atexit, time
+
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+tamanho_pool = 2
+paginas_por_navegador = 50
+limite_javascript = 30.0
+intervalo_javascript = 0.1
+quietude_dom = 0.5
+
+# Devolve true quando a página sinaliza que terminou de rodar o seu JavaScript:
+# - Se a página definir window.livrosReady, só esse sinal vale.
+# - O MathJax, se presente, precisa ter carregado e concluído a sua promise de startup.
+# - O highlight.js, se presente, precisa ter colorido todos os blocos de código, menos os marcados com nohighlight e os
+#   de linguagens que ele não conhece, que ele deixa como estão.
+# - O DOM precisa ter ficado sem mutações por pelo menos quietude_dom segundos.
+script_pronto = """
+    const quietude = arguments[0];
+    if (document.readyState !== "complete") return false;
+    if (window.__livrosMutacao === undefined) {
+        window.__livrosMutacao = performance.now();
+        new MutationObserver(() => { window.__livrosMutacao = performance.now(); })
+                .observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+    }
+    if (window.livrosReady !== undefined) return !!window.livrosReady;
+    if (window.MathJax !== undefined) {
+        if (!window.MathJax.startup || !window.MathJax.startup.promise) return false;
+        if (window.__livrosMathJax === undefined) {
+            window.__livrosMathJax = false;
+            window.MathJax.startup.promise.then(() => { window.__livrosMathJax = true; });
+        }
+        if (!window.__livrosMathJax) return false;
+    }
+    if (window.hljs !== undefined) {
+        const pendentes = document.querySelectorAll("pre code:not(.hljs):not([data-highlighted]):not(.nohighlight):not(.no-highlight)");
+        const linguagem = /\\b(?:lang|language)-([\\w-]+)/;
+        for (const c of pendentes) {
+            const m = linguagem.exec(c.className);
+            if (m === null || window.hljs.getLanguage(m[1])) return false;
+        }
+    }
+    return performance.now() - window.__livrosMutacao >= quietude * 1000;
+"""
+
+def log_navegador(x: str, **campos: object) -> None:
+    barramento.publicar(DEPURACAO, "navegador", x, **campos)
+
+def abrir_firefox() -> "WebDriver":
+    from selenium import webdriver
+    opcoes = webdriver.FirefoxOptions()
+    opcoes.add_argument("-headless")
+    return webdriver.Firefox(options = opcoes)
+
+class Navegador:
+
+    def __init__(self, numero: int, driver: "WebDriver") -> None:
+        self.__numero = numero
+        self.__driver = driver
+        self.__paginas = 0
+
+    @property
+    def driver(self) -> "WebDriver":
+        return self.__driver
+
+    @property
+    def numero(self) -> int:
+        return self.__numero
+
+    @property
+    def paginas(self) -> int:
+        return self.__paginas
+
+    @property
+    def gasto(self) -> bool:
+        return self.__paginas >= paginas_por_navegador
+
+    def contar_pagina(self) -> None:
+        self.__paginas += 1
+
+    @property
+    def saudavel(self) -> bool:
+        try:
+            return self.__driver.execute_script("return 1;") == 1 # type: ignore[no-any-return]
+        except Exception:
+            return False
+
+    def resetar(self) -> bool:
+        try:
+            self.__driver.get("about:blank")
+            self.__driver.delete_all_cookies()
+            return True
+        except Exception:
+            return False
+
+    def fechar(self) -> None:
+        try:
+            self.__driver.quit()
+        except Exception:
+            pass
+
+def aguardar_javascript(driver: "WebDriver") -> tuple[float, bool]:
+    inicio = time.monotonic()
+    while True:
+        pronto = bool(driver.execute_script(script_pronto, quietude_dom))
+        decorrido = time.monotonic() - inicio
+        if pronto or decorrido >= limite_javascript: return decorrido, pronto
+        time.sleep(intervalo_javascript)
+
+class PoolNavegadores:
+
+    def __init__(self, tamanho: int = tamanho_pool, abrir: Callable[[], "WebDriver"] = abrir_firefox) -> None:
+        if tamanho < 1: raise Exception(f"O tamanho do pool de navegadores deve ser positivo, mas foi {tamanho}.")
+        self.__tamanho = tamanho
+        self.__abrir = abrir
+        self.__condicao = Condition()
+        self.__livres: list[Navegador] = [] # Mutável, guardado pela condição.
+        self.__ativos = 0                   # Mutável, guardado pela condição.
+        self.__criados = 0                  # Mutável, guardado pela condição.
+        self.__fechado = False              # Mutável, guardado pela condição.
+        atexit.register(self.fechar)
+
+    @property
+    def tamanho(self) -> int:
+        return self.__tamanho
+
+    @contextmanager
+    def emprestar(self) -> Iterator["WebDriver"]:
+        n = self.__obter()
+        ok = False
+        try:
+            yield n.driver
+            ok = True
+        finally:
+            n.contar_pagina()
+            self.__devolver(n, ok)
+
+    def __obter(self) -> Navegador:
+        with self.__condicao:
+            while True:
+                if self.__fechado: raise Exception("O pool de navegadores já foi fechado.")
+                while self.__livres:
+                    n = self.__livres.pop()
+                    if n.saudavel: return n
+                    log_navegador(f"[Navegador] Descartando o navegador {n.numero}, que não responde.")
+                    self.__descartar(n)
+                if self.__ativos < self.__tamanho:
+                    self.__ativos += 1
+                    self.__criados += 1
+                    numero = self.__criados
+                    break
+                self.__condicao.wait()
+        try:
+            log_navegador(f"[Navegador] Iniciando o navegador {numero}...")
+            return Navegador(numero, self.__abrir())
+        except BaseException:
+            with self.__condicao:
+                self.__ativos -= 1
+                self.__condicao.notify()
+            raise
+
+    def __devolver(self, n: Navegador, ok: bool) -> None:
+        reciclar = not ok or n.gasto or not n.resetar()
+        with self.__condicao:
+            reciclar = reciclar or self.__fechado
+            if reciclar:
+                self.__ativos -= 1
+            else:
+                self.__livres.append(n)
+            self.__condicao.notify()
+        if reciclar:
+            log_navegador(f"[Navegador] Reciclando o navegador {n.numero} após {n.paginas} páginas.")
+            n.fechar()
+
+    # Deve ser chamado com a condição obtida.
+    def __descartar(self, n: Navegador) -> None:
+        self.__ativos -= 1
+        n.fechar()
+
+    def fechar(self) -> None:
+        with self.__condicao:
+            self.__fechado = True
+            livres = self.__livres[:]
+            self.__livres.clear()
+            self.__ativos -= len(livres)
+            self.__condicao.notify_all()
+        for n in livres:
+            n.fechar()
\ No newline at end of file
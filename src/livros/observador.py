@@ -0,0 +1,114 @@
+import livros
+from livros.model import Dir, File, Livro, Recursos, ZipIncremental
+from livros.cache import normalizar
+from livros.metricas import Tempos
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+import os, time, traceback
+
+intervalo_observador = 0.5
+
+# Monta os livros de uma pasta e fica observando-a. A cada alteração, remonta só os livros que dependem dos
+# arquivos alterados (os templates que eles usam, os CSS, fontes e imagens que referenciam e eles mesmos)
+# e regrava o ZIP a partir dos PDFs que ficam guardados na pasta de build.
+# Não usa nenhuma API de notificação do sistema operacional: a pasta é varrida a cada intervalo_observador segundos.
+class Observador:
+
+    def __init__(self, notify: Callable[[str], None], recursos: Recursos, src_dir: Dir, dest: File | None) -> None:
+        if not src_dir.exists: raise Exception(f"O diretório {src_dir.absolute_name} não existe.")
+        if dest is None: dest = src_dir.parent.file(f"out-{src_dir.local_name}.zip")
+        self.__notify = notify
+        self.__recursos = recursos
+        self.__src_dir = src_dir.single_child_down
+        self.__dest = dest
+        self.__temp_dir = Dir.temp()
+        self.__build_dir = self.__temp_dir.subdir("bld")
+        self.__tempos = Tempos(recursos.metricas)
+        self.__dependencias: dict[str, set[str] | None] = {} # Por nome do livro. None: remonta a cada alteração.
+        self.__arquivos: dict[str, tuple[int, int]] = {}      # Caminho -> (mtime, tamanho) na última varredura.
+
+    def executar(self) -> None:
+        self.__build_dir.mkdir()
+        try:
+            self.__arquivos = self.__varrer()
+            self.__montar(self.__livros())
+            self.__notify(f"Observando {self.__src_dir.absolute_name}. Pressione Ctrl+C para encerrar.")
+            while True:
+                time.sleep(intervalo_observador)
+                atual = self.__varrer()
+                alterados = {c for c in atual.keys() | self.__arquivos.keys() if atual.get(c) != self.__arquivos.get(c)}
+                self.__arquivos = atual
+                if alterados: self.__alteracao(alterados)
+        finally:
+            self.__temp_dir.kill()
+
+    def __varrer(self) -> dict[str, tuple[int, int]]:
+        ignorado = normalizar(self.__dest.absolute_name)
+        resultado: dict[str, tuple[int, int]] = {}
+        for raiz, _, arquivos in os.walk(self.__src_dir.absolute_name):
+            for a in arquivos:
+                caminho = normalizar(os.path.join(raiz, a))
+                if caminho == ignorado or caminho.startswith(ignorado + "."): continue
+                try:
+                    st = os.stat(caminho)
+                except OSError:
+                    continue
+                resultado[caminho] = (st.st_mtime_ns, st.st_size)
+        return resultado
+
+    def __livros(self) -> list[str]:
+        return sorted(f.local_name for f in self.__src_dir.files("*.html"))
+
+    def __alteracao(self, alterados: set[str]) -> None:
+        existentes = self.__livros()
+        removidos = [nome for nome in self.__dependencias if nome not in existentes]
+        afetados = [
+            nome for nome in existentes
+            if nome not in self.__dependencias
+            or (d := self.__dependencias[nome]) is None
+            or not d.isdisjoint(alterados)
+        ]
+        for nome in removidos:
+            del self.__dependencias[nome]
+            self.__build_dir.file(f"{File(nome).local_name_no_extension}.pdf").kill()
+            self.__notify(f"[{nome}] Removido.")
+        if not afetados and not removidos: return
+        self.__montar(afetados)
+
+    def __montar(self, nomes: list[str]) -> None:
+        inicio = time.monotonic()
+        livros_ = [Livro(self.__notify, self.__recursos, self.__tempos, self.__src_dir, self.__build_dir, self.__src_dir.file(n), True) for n in nomes]
+        if self.__recursos.trabalhadores == 1 or len(livros_) <= 1:
+            resultados = [self.__montar_livro(livro) for livro in livros_]
+        else:
+            with ThreadPoolExecutor(max_workers = self.__recursos.trabalhadores) as executor:
+                resultados = list(executor.map(self.__montar_livro, livros_))
+        falhas = 0
+        for nome, livro, ok in zip(nomes, livros_, resultados):
+            self.__dependencias[nome] = livro.dependencias if ok else None
+            if not ok: falhas += 1
+        self.__gravar_zip()
+        self.__notify(f"{len(livros_) - falhas} livro(s) montado(s) e {falhas} com falha em {time.monotonic() - inicio:.2f} s. ZIP atualizado: {self.__dest.absolute_name}")
+
+    # Se o livro falhar, o PDF anterior é apagado, e o livro é remontado na próxima alteração de qualquer arquivo.
+    def __montar_livro(self, livro: Livro) -> bool:
+        try:
+            livro.assemble()
+            return True
+        except Exception as x:
+            traceback.print_exc()
+            self.__notify(f"[{livro.output.local_name}] Falha: {x}")
+            livro.output.kill()
+            return False
+
+    # O ZIP é gravado ao lado e depois trocado de uma vez, para que quem o estiver lendo nunca veja um ZIP pela metade.
+    def __gravar_zip(self) -> None:
+        temp = File(f"{self.__dest.absolute_name}.tmp")
+        with self.__tempos.medir("zip"):
+            saida = ZipIncremental(temp)
+            try:
+                for pdf in sorted(self.__build_dir.files("*.pdf"), key = lambda f: f.local_name):
+                    saida.add(pdf)
+            finally:
+                saida.close()
+            os.replace(temp.absolute_name, self.__dest.absolute_name)
\ No newline at end of file
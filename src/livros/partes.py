@@ -0,0 +1,157 @@
+import livros
+from livros.cache import dependencias
+from html.parser import HTMLParser
+from typing import Any
+import bisect, math, os, re
+
+tamanho_parte = 1024 * 1024
+esquema_ancora = "livros-ancora:"
+pixel_em_pontos = 0.75
+
+marcador = "livros:parte"
+elementos_capitulo = ["section", "article", "h1"]
+elementos_vazios = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+corpo = re.compile(r"<body\b[^>]*>", re.IGNORECASE)
+fim_corpo = re.compile(r"</body\s*>", re.IGNORECASE)
+identificador = re.compile(r"""(?<![\w-])id\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+link_interno = re.compile(r"""((?<![\w-])href\s*=\s*["'])#([^"']+)(["'])""", re.IGNORECASE)
+nome_tag = re.compile(r"<\s*([\w-]+)")
+contador_pagina = re.compile(r"counter\(\s*pages?\s*[,)]", re.IGNORECASE)
+
+# Encontra onde os capítulos começam: nos comentários <!-- livros:parte -->, se houver algum, ou então nos elementos
+# section, article e h1 mais externos. Para cada corte, guarda as tags dos elementos que ainda estão abertos ali.
+class Cortes(HTMLParser):
+
+    def __init__(self, texto: str) -> None:
+        super().__init__(convert_charrefs = False)
+        self.__linhas = [0] + [i + 1 for i, c in enumerate(texto) if c == "\n"]
+        self.__abertos: list[tuple[str, str]] = []
+        self.__marcadores: list[tuple[int, list[str]]] = []
+        self.__capitulos: list[tuple[int, list[str]]] = []
+        self.feed(texto)
+        self.close()
+
+    # A posição de cada corte no texto e as tags de abertura dos elementos que o envolvem, do mais externo para o mais interno.
+    @property
+    def marcadores(self) -> list[tuple[int, list[str]]]:
+        return self.__marcadores
+
+    @property
+    def capitulos(self) -> list[tuple[int, list[str]]]:
+        return self.__capitulos
+
+    def __posicao(self) -> int:
+        linha, coluna = self.getpos()
+        return self.__linhas[linha - 1] + coluna
+
+    def __abertas(self) -> list[str]:
+        return [texto for _, texto in self.__abertos]
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag in elementos_capitulo and not any(t in elementos_capitulo for t, _ in self.__abertos):
+            self.__capitulos.append((self.__posicao(), self.__abertas()))
+        if tag not in elementos_vazios: self.__abertos.append((tag, self.get_starttag_text() or f"<{tag}>"))
+
+    def handle_endtag(self, tag: str) -> None:
+        for i in range(len(self.__abertos) - 1, -1, -1):
+            if self.__abertos[i][0] == tag:
+                del self.__abertos[i:]
+                return
+
+    def handle_comment(self, data: str) -> None:
+        if data.strip() == marcador:
+            self.__marcadores.append((self.__posicao(), self.__abertas()))
+
+# Divide o HTML de um livro em até partes documentos, cada um com o mesmo <head> e alguns capítulos seguidos,
+# de tamanhos parecidos. Os elementos que envolvem um corte são reabertos na parte seguinte, sem o id.
+# Devolve None se não houver onde cortar.
+def dividir(html_content: str, partes: int) -> list[str] | None:
+    inicio = corpo.search(html_content)
+    if inicio is None: return None
+    fim = None
+    for fim in fim_corpo.finditer(html_content, inicio.end()):
+        pass
+    if fim is None: return None
+    conteudo = html_content[inicio.end():fim.start()]
+    cortes = Cortes(conteudo)
+    candidatos = [c for c in cortes.marcadores or cortes.capitulos if c[0] > 0]
+    if not candidatos or partes < 2: return None
+
+    # Escolhe, para cada fração do tamanho total, o primeiro capítulo que começa depois dela.
+    escolhidos: list[tuple[int, list[str]]] = []
+    posicoes = [p for p, _ in candidatos]
+    for k in range(1, partes):
+        i = bisect.bisect_left(posicoes, math.ceil(len(conteudo) * k / partes))
+        if i < len(candidatos) and (not escolhidos or candidatos[i][0] > escolhidos[-1][0]): escolhidos.append(candidatos[i])
+    if not escolhidos: return None
+
+    cabeca = html_content[:inicio.end()]
+    rodape = html_content[fim.start():]
+    resultado: list[str] = []
+    anterior: tuple[int, list[str]] = (0, [])
+    for corte in escolhidos + [(len(conteudo), [])]:
+        reabertos = "".join(identificador.sub("", t) for t in anterior[1])
+        fechados = "".join(f"</{nome_tag.match(t).group(1)}>" for t in reversed(corte[1])) # type: ignore[union-attr]
+        resultado.append(cabeca + reabertos + conteudo[anterior[0]:corte[0]] + fechados + rodape)
+        anterior = corte
+    return resultado
+
+# Os links para âncoras que ficaram em outra parte são trocados por links para esquema_ancora, que não são
+# resolvidos pelo WeasyPrint e depois são apontados para a página certa por juntar.
+def ligar_ancoras(partes: list[str]) -> list[str]:
+    ids = [set(identificador.findall(p)) for p in partes]
+    todos = set().union(*ids)
+
+    def religar(proprios: set[str]) -> Any:
+        def trocar(m: re.Match[str]) -> str:
+            if m.group(2) in proprios or m.group(2) not in todos: return m.group(0)
+            return f"{m.group(1)}{esquema_ancora}{m.group(2)}{m.group(3)}"
+        return trocar
+
+    return [link_interno.sub(religar(ids[i]), p) for i, p in enumerate(partes)]
+
+# Se o livro mostra números de página, as partes depois da primeira precisam começar a contar de onde a anterior parou.
+def usa_contador_de_pagina(html_content: str, src_dir: str) -> bool:
+    if contador_pagina.search(html_content) is not None: return True
+    for caminho in dependencias(html_content, src_dir):
+        if not caminho.lower().endswith(".css") or not os.path.isfile(caminho): continue
+        with open(caminho, "r", encoding = "utf-8", errors = "replace") as f:
+            if contador_pagina.search(f.read()) is not None: return True
+    return False
+
+def numerar(parte: str, paginas_anteriores: int) -> str:
+    estilo = f"<style>@page :first {{ counter-reset: page {paginas_anteriores}; }}</style>"
+    fim_cabeca = re.search(r"</head\s*>", parte, re.IGNORECASE)
+    if fim_cabeca is None: return estilo + parte
+    return parte[:fim_cabeca.start()] + estilo + parte[fim_cabeca.start():]
+
+# Junta os PDFs das partes num só, mantendo os marcadores de cada uma, e liga os links entre partes.
+# As âncoras de cada parte vão do nome para a página dentro da parte e a posição em pixels do CSS.
+def juntar(arquivos: list[str], ancoras: list[dict[str, tuple[int, float, float]]], destino: str) -> None:
+    from pypdf import PdfReader, PdfWriter # type: ignore[import-not-found, unused-ignore]
+    from pypdf.generic import ArrayObject, FloatObject, NameObject, NullObject # type: ignore[import-not-found, unused-ignore]
+    saida = PdfWriter()
+    globais: dict[str, tuple[int, float, float]] = {}
+    for arquivo, proprias in zip(arquivos, ancoras):
+        inicio = len(saida.pages)
+        leitor = PdfReader(arquivo)
+        if inicio == 0 and leitor.metadata is not None: saida.add_metadata(leitor.metadata)
+        saida.append(leitor)
+        for nome, (pagina, x, y) in proprias.items():
+            globais.setdefault(nome, (inicio + pagina, x, y))
+    for origem in saida.pages:
+        for referencia in origem.get("/Annots") or []:
+            anotacao = referencia.get_object()
+            acao = anotacao.get("/A")
+            if acao is None: continue
+            uri = str(acao.get_object().get("/URI", ""))
+            if not uri.startswith(esquema_ancora) or uri[len(esquema_ancora):] not in globais: continue
+            numero, x, y = globais[uri[len(esquema_ancora):]]
+            alvo = saida.pages[numero]
+            topo = float(alvo.mediabox.top)
+            anotacao[NameObject("/Dest")] = ArrayObject([
+                alvo.indirect_reference, NameObject("/XYZ"), FloatObject(x * pixel_em_pontos), FloatObject(topo - y * pixel_em_pontos), NullObject()
+            ])
+            del anotacao["/A"]
+    with open(destino, "wb") as f:
+        saida.write(f)
\ No newline at end of file
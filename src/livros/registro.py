@@ -0,0 +1,318 @@
+import livros
+from livros.agendador import FilaCheia
+from livros.eventos import Evento, SaidaAssincrona
+from abc import ABC, abstractmethod
+from typing import Any, Iterator
+from contextlib import contextmanager
+import json, math, os, sqlite3, time
+
+intervalo_registro = 0.5
+duracao_estimada = 60.0
+intervalo_batimento = 15.0
+limite_batimento = 120.0
+
+# Guarda o estado dos pacotes fora do processo, para que vários servidores (ou máquinas com a mesma pasta temp montada
+# no mesmo caminho) atendam os mesmos pacotes. Cada servidor reivindica os pacotes da fila para montá-los e publica aqui
+# as linhas de status, os livros prontos e o resultado. Qualquer servidor responde pelo status e pelo download.
+# O cursor do status é o número de linhas já emitidas, como em Pacote.status_desde.
+class Registro(ABC):
+
+    # Não faz nada se o pacote já estiver registrado.
+    @abstractmethod
+    def registrar(self, nome: str, temp_dir: str, src_dir: str, saida: str, motor: str | None) -> None:
+        ...
+
+    # A pasta temporária, a pasta com o conteúdo, o ZIP de saída e o motor do pacote.
+    @abstractmethod
+    def localizar(self, nome: str) -> tuple[str, str, str, str | None] | None:
+        ...
+
+    # Coloca o pacote na fila, ou lança FilaCheia se ela estiver cheia ou se o cliente já tiver pacotes demais nela.
+    @abstractmethod
+    def enfileirar(self, nome: str, cliente: str, tamanho: int, por_cliente: int, trabalhadores: int) -> None:
+        ...
+
+    @abstractmethod
+    def verificar(self, cliente: str, tamanho: int, por_cliente: int, trabalhadores: int) -> None:
+        ...
+
+    # Tira da fila o próximo pacote a ser montado, atomicamente, e o marca como sendo montado pelo dono.
+    @abstractmethod
+    def reivindicar(self, dono: str) -> str | None:
+        ...
+
+    # Enquanto estiver vivo, o dono renova a cada intervalo_batimento segundos o batimento dos pacotes que está montando.
+    @abstractmethod
+    def pulsar(self, dono: str) -> None:
+        ...
+
+    # Os pacotes cujo batimento não é renovado há mais de limite segundos foram abandonados por um processo que morreu.
+    # Eles são concluídos com a falha dada, e os seus nomes são devolvidos.
+    @abstractmethod
+    def recuperar(self, limite: float, falha: str) -> list[str]:
+        ...
+
+    @abstractmethod
+    def posicao(self, nome: str) -> int | None:
+        ...
+
+    # Recebe as linhas novas de cada pacote e guarda só as últimas limite linhas de cada um, como o status em memória.
+    # As linhas de pacotes que não estão mais registrados são ignoradas.
+    @abstractmethod
+    def adicionar_status(self, linhas: dict[str, list[str]], limite: int) -> None:
+        ...
+
+    @abstractmethod
+    def status_desde(self, nome: str, cursor: int) -> tuple[int, list[str]]:
+        ...
+
+    @abstractmethod
+    def livro_pronto(self, nome: str, livro: str, tempos: dict[str, object]) -> None:
+        ...
+
+    @abstractmethod
+    def concluir(self, nome: str, falha: str | None, tempos: dict[str, object]) -> None:
+        ...
+
+    # O momento (em segundos desde a época) em que o pacote ficou pronto, a falha, os livros prontos e o resumo dos tempos.
+    @abstractmethod
+    def situacao(self, nome: str) -> tuple[float | None, str | None, list[str], dict[str, object]]:
+        ...
+
+    @abstractmethod
+    def remover(self, nome: str) -> None:
+        ...
+
+    @abstractmethod
+    def nomes(self) -> set[str]:
+        ...
+
+    @property
+    @abstractmethod
+    def estatisticas(self) -> dict[str, int]:
+        ...
+
+    # Como status_desde, mas se não houver nada novo, consulta de novo até que haja, até que o pacote termine ou até o timeout.
+    def aguardar_status(self, nome: str, cursor: int, timeout: float) -> tuple[int, list[str]]:
+        limite = time.monotonic() + timeout
+        while True:
+            proximo, linhas = self.status_desde(nome, cursor)
+            if linhas or self.situacao(nome)[0] is not None or time.monotonic() >= limite: return proximo, linhas
+            time.sleep(min(intervalo_registro, max(0.0, limite - time.monotonic())))
+
+esquema = """
+CREATE TABLE IF NOT EXISTS pacotes (
+    nome TEXT PRIMARY KEY,
+    temp_dir TEXT NOT NULL,
+    src_dir TEXT NOT NULL,
+    saida TEXT NOT NULL,
+    motor TEXT,
+    cliente TEXT,
+    estado TEXT NOT NULL,
+    dono TEXT,
+    enfileirado REAL,
+    iniciado REAL,
+    batimento REAL,
+    pronto REAL,
+    falha TEXT,
+    prontos TEXT NOT NULL DEFAULT '[]',
+    tempos TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS pacotes_estado ON pacotes (estado, enfileirado);
+CREATE TABLE IF NOT EXISTS status (
+    pacote TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    linha TEXT NOT NULL,
+    PRIMARY KEY (pacote, seq)
+);
+"""
+
+# Os pacotes passam pelos estados criado, fila, montando, pronto e falha. A fila é atendida em rodízio entre os
+# clientes: vai primeiro o pacote mais antigo do cliente atendido há mais tempo (ou nunca atendido).
+# Cada operação abre a sua própria conexão, o que serve para qualquer thread e qualquer processo. O SQLite usa o
+# journal padrão, e não o WAL, porque o WAL não funciona com o arquivo numa pasta compartilhada pela rede.
+class RegistroSQLite(Registro):
+
+    def __init__(self, arquivo: str) -> None:
+        self.__arquivo = os.path.abspath(arquivo)
+        c = sqlite3.connect(self.__arquivo, timeout = 30)
+        try:
+            c.executescript(esquema)
+            # Os registros criados antes do batimento não têm a coluna. Outro processo pode tê-la criado ao mesmo tempo.
+            if "batimento" not in {r[1] for r in c.execute("PRAGMA table_info(pacotes)")}:
+                try:
+                    c.execute("ALTER TABLE pacotes ADD COLUMN batimento REAL")
+                except sqlite3.OperationalError:
+                    pass
+        finally:
+            c.close()
+
+    @contextmanager
+    def __conectar(self, imediato: bool = False) -> Iterator[sqlite3.Connection]:
+        c = sqlite3.connect(self.__arquivo, timeout = 30, isolation_level = None)
+        try:
+            c.execute("BEGIN IMMEDIATE" if imediato else "BEGIN")
+            try:
+                yield c
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+        finally:
+            c.close()
+
+    def registrar(self, nome: str, temp_dir: str, src_dir: str, saida: str, motor: str | None) -> None:
+        with self.__conectar(True) as c:
+            c.execute(
+                "INSERT OR IGNORE INTO pacotes (nome, temp_dir, src_dir, saida, motor, estado) VALUES (?, ?, ?, ?, ?, 'criado')",
+                (nome, temp_dir, src_dir, saida, motor)
+            )
+
+    def localizar(self, nome: str) -> tuple[str, str, str, str | None] | None:
+        with self.__conectar() as c:
+            r = c.execute("SELECT temp_dir, src_dir, saida, motor FROM pacotes WHERE nome = ?", (nome,)).fetchone()
+        return None if r is None else (r[0], r[1], r[2], r[3])
+
+    # Deve ser chamado dentro de uma transação.
+    def __verificar(self, c: sqlite3.Connection, cliente: str, tamanho: int, por_cliente: int, trabalhadores: int) -> None:
+        pendentes, do_cliente = c.execute(
+            "SELECT COUNT(*), COALESCE(SUM(cliente = ?), 0) FROM pacotes WHERE estado = 'fila'", (cliente,)
+        ).fetchone()
+        if pendentes < tamanho and do_cliente < por_cliente: return
+        media = c.execute(
+            "SELECT AVG(pronto - iniciado) FROM (SELECT pronto, iniciado FROM pacotes WHERE pronto IS NOT NULL AND iniciado IS NOT NULL ORDER BY pronto DESC LIMIT 20)"
+        ).fetchone()[0]
+        estimativa = max(1, math.ceil((duracao_estimada if media is None else media) * math.ceil((pendentes + 1) / trabalhadores)))
+        if pendentes >= tamanho: raise FilaCheia("A fila de pacotes está cheia. Tente novamente mais tarde.", False, estimativa)
+        raise FilaCheia(f"Você já tem {do_cliente} pacotes na fila. Aguarde algum deles terminar.", True, estimativa)
+
+    def verificar(self, cliente: str, tamanho: int, por_cliente: int, trabalhadores: int) -> None:
+        with self.__conectar() as c:
+            self.__verificar(c, cliente, tamanho, por_cliente, trabalhadores)
+
+    def enfileirar(self, nome: str, cliente: str, tamanho: int, por_cliente: int, trabalhadores: int) -> None:
+        with self.__conectar(True) as c:
+            self.__verificar(c, cliente, tamanho, por_cliente, trabalhadores)
+            c.execute(
+                "UPDATE pacotes SET estado = 'fila', cliente = ?, enfileirado = ? WHERE nome = ? AND estado = 'criado'",
+                (cliente, time.time(), nome)
+            )
+
+    def reivindicar(self, dono: str) -> str | None:
+        with self.__conectar(True) as c:
+            r = c.execute("""
+                SELECT p.nome FROM pacotes p
+                WHERE p.estado = 'fila'
+                ORDER BY (SELECT MAX(q.iniciado) FROM pacotes q WHERE q.cliente = p.cliente), p.enfileirado
+                LIMIT 1
+            """).fetchone()
+            if r is None: return None
+            agora = time.time()
+            c.execute("UPDATE pacotes SET estado = 'montando', dono = ?, iniciado = ?, batimento = ? WHERE nome = ?", (dono, agora, agora, r[0]))
+            return str(r[0])
+
+    def pulsar(self, dono: str) -> None:
+        with self.__conectar(True) as c:
+            c.execute("UPDATE pacotes SET batimento = ? WHERE estado = 'montando' AND dono = ?", (time.time(), dono))
+
+    def recuperar(self, limite: float, falha: str) -> list[str]:
+        with self.__conectar(True) as c:
+            agora = time.time()
+            nomes = [str(r[0]) for r in c.execute(
+                "SELECT nome FROM pacotes WHERE estado = 'montando' AND COALESCE(batimento, iniciado, 0) < ?", (agora - limite,)
+            )]
+            c.executemany("UPDATE pacotes SET estado = 'falha', pronto = ?, falha = ? WHERE nome = ?", [(agora, falha, n) for n in nomes])
+        return nomes
+
+    # Simula o rodízio da mesma forma que reivindicar.
+    def posicao(self, nome: str) -> int | None:
+        with self.__conectar() as c:
+            fila = c.execute("""
+                SELECT p.nome, p.cliente, (SELECT MAX(q.iniciado) FROM pacotes q WHERE q.cliente = p.cliente) AS atendido
+                FROM pacotes p WHERE p.estado = 'fila' ORDER BY atendido, p.enfileirado
+            """).fetchall()
+        por_cliente: dict[str, list[str]] = {}
+        for n, cliente, _ in fila:
+            por_cliente.setdefault(cliente, []).append(n)
+        posicao = 0
+        filas = list(por_cliente.values())
+        for rodada in range(max((len(f) for f in filas), default = 0)):
+            for f in filas:
+                if rodada >= len(f): continue
+                posicao += 1
+                if f[rodada] == nome: return posicao
+        return None
+
+    def adicionar_status(self, linhas: dict[str, list[str]], limite: int) -> None:
+        with self.__conectar(True) as c:
+            for nome, novas in linhas.items():
+                if c.execute("SELECT 1 FROM pacotes WHERE nome = ?", (nome,)).fetchone() is None: continue
+                inicio = c.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM status WHERE pacote = ?", (nome,)).fetchone()[0]
+                c.executemany("INSERT INTO status (pacote, seq, linha) VALUES (?, ?, ?)", [(nome, inicio + i, linha) for i, linha in enumerate(novas)])
+                c.execute("DELETE FROM status WHERE pacote = ? AND seq < ?", (nome, inicio + len(novas) - limite))
+
+    # As linhas que já saíram do status são puladas.
+    def status_desde(self, nome: str, cursor: int) -> tuple[int, list[str]]:
+        with self.__conectar() as c:
+            linhas = c.execute("SELECT seq, linha FROM status WHERE pacote = ? AND seq >= ? ORDER BY seq", (nome, cursor)).fetchall()
+            if not linhas:
+                proximo: int = c.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM status WHERE pacote = ?", (nome,)).fetchone()[0]
+                return proximo, []
+        return linhas[-1][0] + 1, [linha for _, linha in linhas]
+
+    def livro_pronto(self, nome: str, livro: str, tempos: dict[str, object]) -> None:
+        with self.__conectar(True) as c:
+            r = c.execute("SELECT prontos FROM pacotes WHERE nome = ?", (nome,)).fetchone()
+            if r is None: return
+            prontos: list[str] = json.loads(r[0])
+            prontos.append(livro)
+            c.execute("UPDATE pacotes SET prontos = ?, tempos = ? WHERE nome = ?", (json.dumps(prontos), json.dumps(tempos), nome))
+
+    def concluir(self, nome: str, falha: str | None, tempos: dict[str, object]) -> None:
+        with self.__conectar(True) as c:
+            c.execute(
+                "UPDATE pacotes SET estado = ?, pronto = ?, falha = ?, tempos = ? WHERE nome = ?",
+                ("pronto" if falha is None else "falha", time.time(), falha, json.dumps(tempos), nome)
+            )
+
+    def situacao(self, nome: str) -> tuple[float | None, str | None, list[str], dict[str, object]]:
+        with self.__conectar() as c:
+            r = c.execute("SELECT pronto, falha, prontos, tempos FROM pacotes WHERE nome = ?", (nome,)).fetchone()
+        if r is None: return None, None, [], {}
+        return r[0], r[1], json.loads(r[2]), json.loads(r[3])
+
+    def remover(self, nome: str) -> None:
+        with self.__conectar(True) as c:
+            c.execute("DELETE FROM status WHERE pacote = ?", (nome,))
+            c.execute("DELETE FROM pacotes WHERE nome = ?", (nome,))
+
+    def nomes(self) -> set[str]:
+        with self.__conectar() as c:
+            return {r[0] for r in c.execute("SELECT nome FROM pacotes")}
+
+    @property
+    def estatisticas(self) -> dict[str, int]:
+        with self.__conectar() as c:
+            contagens: dict[str, Any] = dict(c.execute("SELECT estado, COUNT(*) FROM pacotes GROUP BY estado").fetchall())
+        return {"pendentes": contagens.get("fila", 0), "executando": contagens.get("montando", 0)}
+
+# Grava no registro as linhas de status dos pacotes montados por este processo, numa thread própria, para que publicar
+# um status não espere pelo SQLite. As linhas que chegam durante uma gravação vão todas juntas na seguinte, numa só
+# transação.
+class SaidaRegistro(SaidaAssincrona):
+
+    def __init__(self, registro: Registro, limite: int) -> None:
+        self.__registro = registro
+        self.__limite = limite
+        self.__pendentes: dict[str, list[str]] = {} # Mutável, usado só pela thread da saída.
+        super().__init__()
+
+    def escrever(self, evento: Evento) -> None:
+        if not evento.canal.startswith("pacote."): return
+        self.__pendentes.setdefault(evento.canal[len("pacote."):], []).append(evento.mensagem)
+
+    def descarregar(self) -> None:
+        if not self.__pendentes: return
+        pendentes = self.__pendentes
+        self.__pendentes = {}
+        self.__registro.adicionar_status(pendentes, self.__limite)
\ No newline at end of file
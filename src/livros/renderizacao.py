@@ -0,0 +1,163 @@
+import livros
+from livros.cache import resolver_referencia
+from collections import OrderedDict
+from threading import RLock
+from typing import Any, Callable, TYPE_CHECKING
+import os
+
+if TYPE_CHECKING:
+    from weasyprint import URLFetcher, URLFetcherResponse
+
+limite_weasyprint = 256 * 1024 * 1024
+limite_pacotes = 8
+
+# A URL final, o conteúdo, os cabeçalhos e o status de uma resposta do url_fetcher.
+Guardado = tuple[str, bytes, dict[str, str], Any]
+
+# Recursos do WeasyPrint compartilhados entre os livros renderizados por um processo:
+# * Os arquivos buscados pelo url_fetcher (CSS, fontes, imagens e o que vier da internet), em memória e com limite de bytes.
+#   Arquivos locais são identificados pelo caminho, data de modificação e tamanho; os demais só pela URL.
+# * Para cada pacote, um FontConfiguration e o cache de imagens já decodificadas. Eles não são compartilhados entre
+#   pacotes porque duas @font-face de pacotes diferentes podem usar o mesmo nome de família com arquivos diferentes.
+#   Só os limite_pacotes pacotes usados mais recentemente são mantidos, e as suas imagens entram no mesmo limite de
+#   bytes dos arquivos.
+# Os contadores de acertos e faltas são retirados a cada PDF e somados nas métricas do processo principal.
+class CacheWeasyPrint:
+
+    def __init__(self, limite: int = limite_weasyprint) -> None:
+        if limite < 0: raise Exception(f"O limite do cache do WeasyPrint não pode ser negativo, mas foi {limite}.")
+        self.__limite = limite
+        self.__lock = RLock()
+        self.__arquivos: OrderedDict[tuple[str, int, int], Guardado] = OrderedDict() # Mutável, guardado pelo lock.
+        self.__total = 0                                                             # Mutável, guardado pelo lock.
+        self.__pacotes: OrderedDict[str, tuple[Any, dict[str, Any]]] = OrderedDict() # Mutável, guardado pelo lock.
+        self.__imagens: dict[str, int] = {}                                          # Mutável, guardado pelo lock. Bytes das imagens de cada pacote.
+        self.__total_imagens = 0                                                     # Mutável, guardado pelo lock.
+        self.__contadores: dict[str, int] = {}                                       # Mutável, guardado pelo lock.
+
+    # Um URLFetcher do WeasyPrint que passa por este cache. É criado um a cada render, pois o URLFetcher guarda o
+    # pedido em andamento nos redirecionamentos e não pode ser usado por duas threads ao mesmo tempo.
+    def url_fetcher(self) -> "URLFetcher":
+        from weasyprint import URLFetcher
+        buscar = self.__buscar
+
+        class FetcherCacheado(URLFetcher):
+            def fetch(self, url: str, headers: dict[str, str] | None = None) -> "URLFetcherResponse":
+                return buscar(url, lambda: super(FetcherCacheado, self).fetch(url, headers))
+
+        return FetcherCacheado()
+
+    def __buscar(self, url: str, baixar: Callable[[], "URLFetcherResponse"]) -> "URLFetcherResponse":
+        from weasyprint.urls import URLFetcherResponse as Resposta # type: ignore[import-untyped, import-not-found, unused-ignore]
+        chave = CacheWeasyPrint.__chave(url)
+        if chave is None: return baixar()
+        with self.__lock:
+            guardado = self.__arquivos.get(chave)
+            if guardado is not None:
+                self.__arquivos.move_to_end(chave)
+                self.__contar('tipo="arquivo",resultado="acerto"')
+            else:
+                self.__contar('tipo="arquivo",resultado="falta"')
+        if guardado is None:
+            resposta = baixar()
+            try:
+                guardado = (resposta.url, resposta.read(), dict(resposta.headers.items()), resposta.status)
+            finally:
+                resposta.close()
+            tamanho = len(guardado[1])
+            if tamanho <= self.__limite // 4:
+                with self.__lock:
+                    if chave not in self.__arquivos:
+                        self.__arquivos[chave] = guardado
+                        self.__total += tamanho
+                    self.__evict_arquivos()
+        resposta_url, corpo, cabecalhos, situacao = guardado
+        r: URLFetcherResponse = Resposta(resposta_url, corpo, cabecalhos, situacao)
+        return r
+
+    @staticmethod
+    def __chave(url: str) -> tuple[str, int, int] | None:
+        if url.startswith("data:"): return None
+        if not url.startswith("file:"): return url, 0, 0
+        caminho = resolver_referencia(url, "")
+        if caminho is None: return None
+        try:
+            st = os.stat(caminho)
+        except OSError:
+            return None
+        return url, st.st_mtime_ns, st.st_size
+
+    # O FontConfiguration e o dicionário de imagens a serem passados para o render dos livros de um pacote.
+    def pacote(self, chave: str) -> tuple[Any, dict[str, Any]]:
+        from weasyprint.text.fonts import FontConfiguration # type: ignore[import-untyped, import-not-found, unused-ignore]
+        with self.__lock:
+            recursos = self.__pacotes.get(chave)
+            if recursos is not None:
+                self.__pacotes.move_to_end(chave)
+                self.__contar('tipo="pacote",resultado="acerto"')
+                return recursos
+            self.__contar('tipo="pacote",resultado="falta"')
+            recursos = (FontConfiguration(), {})
+            self.__pacotes[chave] = recursos
+            while len(self.__pacotes) > limite_pacotes:
+                self.__esquecer(next(iter(self.__pacotes)))
+            return recursos
+
+    # Chamado depois de cada PDF, com o cache de imagens do pacote já preenchido pelo WeasyPrint. Enquanto os arquivos e
+    # as imagens passarem do limite, são esquecidas as imagens dos pacotes usados há mais tempo e depois os arquivos.
+    # O dicionário de imagens de um pacote nunca é esvaziado, só trocado por um novo, pois um render em andamento pode
+    # estar usando o antigo, e as imagens guardadas nele se referem umas às outras pelas chaves.
+    def medir_pacote(self, chave: str) -> None:
+        with self.__lock:
+            recursos = self.__pacotes.get(chave)
+            if recursos is None: return
+            tamanho = sum(len(v) for v in list(recursos[1].values()) if isinstance(v, (bytes, bytearray)))
+            if tamanho > self.__limite // 4:
+                self.__pacotes[chave] = (recursos[0], {})
+                tamanho = 0
+            self.__total_imagens += tamanho - self.__imagens.get(chave, 0)
+            self.__imagens[chave] = tamanho
+            for antigo in [k for k in self.__pacotes if k != chave and self.__imagens.get(k, 0) > 0]:
+                if self.__total + self.__total_imagens <= self.__limite: break
+                self.__pacotes[antigo] = (self.__pacotes[antigo][0], {})
+                self.__total_imagens -= self.__imagens.pop(antigo)
+            self.__evict_arquivos()
+
+    # Deve ser chamado com o lock obtido.
+    def __esquecer(self, chave: str) -> None:
+        self.__pacotes.pop(chave, None)
+        self.__total_imagens -= self.__imagens.pop(chave, 0)
+
+    # Deve ser chamado com o lock obtido.
+    def __evict_arquivos(self) -> None:
+        while self.__total + self.__total_imagens > self.__limite and self.__arquivos:
+            self.__total -= len(self.__arquivos.popitem(last = False)[1][1])
+
+    # Deve ser chamado com o lock obtido.
+    def __contar(self, rotulos: str) -> None:
+        self.__contadores[rotulos] = self.__contadores.get(rotulos, 0) + 1
+
+    def retirar_contadores(self) -> dict[str, int]:
+        with self.__lock:
+            contadores = self.__contadores
+            self.__contadores = {}
+            return contadores
+
+    @property
+    def estatisticas(self) -> dict[str, int]:
+        with self.__lock:
+            return {
+                "arquivos": len(self.__arquivos),
+                "bytes": self.__total,
+                "bytes_imagens": self.__total_imagens,
+                "limite": self.__limite,
+                "pacotes": len(self.__pacotes),
+            }
+
+cache_processo: CacheWeasyPrint | None = None
+
+# Chamado uma vez em cada processo que renderiza PDFs.
+def configurar(limite: int) -> CacheWeasyPrint:
+    global cache_processo
+    cache_processo = CacheWeasyPrint(limite)
+    return cache_processo
\ No newline at end of file
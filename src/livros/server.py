@@ -1,11 +1,51 @@
 import livros
-from livros.model import Biblioteca, Dir, File, UnsavedFile
-from flask import Flask, jsonify, redirect, request, render_template, send_file, url_for
+from livros.model import Biblioteca, Dir, File, Pacote, UnsavedFile, validade_pacote
+from livros.agendador import FilaCheia
+from livros.motor import motores
+from flask import Flask, jsonify, redirect, request, render_template, send_file, stream_with_context, url_for
 from werkzeug.wrappers.response import Response
-from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable, TooManyRequests
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
-from threading import Thread
+from threading import RLock, Thread
+from collections import OrderedDict
+from datetime import datetime
+from typing import IO, Iterator
+from urllib.parse import quote
+import hashlib, json, os, time
+
+intervalo_transmissao = 0.5
+intervalo_eventos = 5.0
+limite_etags = 4096
+
+lock_etags = RLock()
+etags: OrderedDict[tuple[str, int, int], str] = OrderedDict() # Mutável, guardado pelo lock_etags.
+
+# O SHA-256 do conteúdo do arquivo. Fica guardado enquanto o arquivo não mudar, para não ser recalculado a cada download.
+def etag_arquivo(caminho: str) -> str:
+    st = os.stat(caminho)
+    chave = (caminho, st.st_mtime_ns, st.st_size)
+    with lock_etags:
+        etag = etags.get(chave)
+        if etag is not None:
+            etags.move_to_end(chave)
+            return etag
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloco)
+    etag = h.hexdigest()
+    with lock_etags:
+        etags[chave] = etag
+        while len(etags) > limite_etags:
+            etags.popitem(last = False)
+    return etag
+
+# Um pacote pronto não muda mais até ser apagado pelo zelador, então os seus arquivos podem ficar em cache até lá.
+def armazenar_ate_expirar(resposta: Response, pronto: datetime) -> Response:
+    restante = max(0, int((validade_pacote - (datetime.now() - pronto)).total_seconds()))
+    resposta.headers["Cache-Control"] = f"private, max-age={restante}, immutable"
+    return resposta
 
 class ServerUnsavedFile(UnsavedFile):
 
@@ -19,14 +59,73 @@ class ServerUnsavedFile(UnsavedFile):
         self.__arquivo.save(f.absolute_name)
         return f
 
+    @property
+    def stream(self) -> IO[bytes]:
+        return self.__arquivo.stream
+
+# Lê o ZIP enquanto ele ainda está sendo escrito, esperando por mais dados até que o pacote termine.
+def transmitir_zip(p: Pacote) -> Iterator[bytes]:
+    with open(p.out_file.absolute_name, "rb") as f:
+        while True:
+            bloco = f.read(64 * 1024)
+            if bloco:
+                yield bloco
+            elif p.falha is not None:
+                return
+            elif p.pronto is not None:
+                resto = f.read()
+                if not resto: return
+                yield resto
+            else:
+                time.sleep(intervalo_transmissao)
+
+# Server-Sent Events: cada mensagem traz só as linhas de status novas, e o seu id é o cursor para retomar a partir dali.
+# Se nada mudar por intervalo_eventos segundos, é enviado um comentário só para manter a conexão viva.
+def transmitir_eventos(biblioteca: Biblioteca, p: Pacote, cursor: int) -> Iterator[str]:
+    anterior: tuple[int | None, list[str]] | None = None
+    while True:
+        concluido = p.pronto is not None
+        cursor, linhas = p.status_desde(cursor) if concluido else p.aguardar_status(cursor, intervalo_eventos)
+        posicao, prontos = biblioteca.posicao_na_fila(p), p.prontos
+        if linhas or (posicao, prontos) != anterior:
+            anterior = (posicao, prontos)
+            yield f"id: {cursor}\ndata: {json.dumps({'status': linhas, 'posicao': posicao, 'prontos': prontos})}\n\n"
+        else:
+            yield ": aguardando\n\n"
+        if concluido:
+            falha = p.falha
+            yield f"event: fim\ndata: {json.dumps({'codigo': 201 if falha is None else 500, 'falha': falha})}\n\n"
+            return
+
+# O envio dos ZIPs prontos pode ser delegado a um proxy na frente do servidor, que também cuida do Range:
+# * sendfile: o Flask responde com o cabeçalho X-Sendfile (Apache com mod_xsendfile, lighttpd).
+# * /<prefixo>: responde com X-Accel-Redirect para <prefixo>/<caminho dentro da pasta temp> (nginx, com uma location
+#   internal apontando para a pasta temp).
+# O If-None-Match é respondido pelo próprio servidor nos dois casos.
 class ServidorLivros:
 
-    def __init__(self, biblioteca: Biblioteca, port: int = 13013) -> None:
+    def __init__(self, biblioteca: Biblioteca, port: int = 13013, acelerar: str | None = None) -> None:
+        if acelerar is not None and acelerar != "sendfile" and not acelerar.startswith("/"):
+            raise Exception(f"A aceleração deve ser sendfile ou um prefixo começando com /, mas foi {acelerar}.")
         self.__app = Flask(__name__)
         self.__biblioteca = biblioteca
         self.__port = port
 
         app = self.__app
+        app.config["USE_X_SENDFILE"] = acelerar == "sendfile"
+        temp = Dir("temp").absolute_name + "/"
+
+        def enviar_zip(f: File, pronto: datetime) -> Response:
+            etag = etag_arquivo(f.absolute_name)
+            if acelerar is None or acelerar == "sendfile" or not f.absolute_name.startswith(temp):
+                return armazenar_ate_expirar(send_file(f.absolute_name, etag = etag, conditional = True), pronto)
+            if request.if_none_match.contains(etag):
+                resposta = Response(status = 304)
+            else:
+                interno = f"{acelerar.rstrip('/')}/{quote(f.absolute_name[len(temp):])}"
+                resposta = Response(mimetype = "application/zip", headers = {"X-Accel-Redirect": interno})
+            resposta.set_etag(etag)
+            return armazenar_ate_expirar(resposta, pronto)
 
         @app.get("/")
         def index() -> str:
@@ -36,12 +135,37 @@ class ServidorLivros:
         def upload() -> Response:
             if "zip" not in request.files: raise BadRequest()
             arquivo = request.files["zip"]
+            motor = request.form.get("motor") or None
+            if motor is not None and motor not in motores: raise BadRequest()
             f = ServerUnsavedFile(arquivo)
-            p = biblioteca.criar_pacote_unsaved(f, None)
-            r = redirect(url_for("tela_espera", arq = p.nome))
-            t = Thread(target = p.assemble, args = ())
-            t.start()
-            return r
+            cliente = request.remote_addr or ""
+            try:
+                p = biblioteca.criar_pacote_unsaved(f, None, motor, cliente)
+                biblioteca.agendar(p, cliente)
+            except FilaCheia as x:
+                if x.por_cliente: raise TooManyRequests(str(x), retry_after = x.retry_after)
+                raise ServiceUnavailable(str(x), retry_after = x.retry_after)
+            return redirect(url_for("tela_espera", arq = p.nome))
+
+        @app.get("/metrics")
+        def metrics() -> Response:
+            medidores: dict[str, float] = {}
+            for k, v in biblioteca.estatisticas_fila.items():
+                medidores[f"livros_agendador_{k}"] = v
+            cache = biblioteca.recursos.cache
+            if cache is not None:
+                for k, v in cache.estatisticas.items():
+                    medidores[f"livros_cache_{k}"] = v
+            weasyprint = biblioteca.recursos.weasyprint
+            if weasyprint is not None:
+                for k, v in weasyprint.estatisticas.items():
+                    medidores[f"livros_weasyprint_{k}"] = v
+            zelador = biblioteca.zelador
+            if zelador is not None:
+                for k, v in zelador.estatisticas.items():
+                    medidores[f"livros_zelador_{k}"] = v
+            texto = biblioteca.recursos.metricas.exportar(medidores)
+            return Response(texto, mimetype = "text/plain; version=0.0.4")
 
         @app.get("/<arq>/espera")
         def tela_espera(arq: str) -> str:
@@ -51,14 +175,41 @@ class ServidorLivros:
         def status(arq: str) -> tuple[Response, int]:
             p = biblioteca.localizar_pacote(arq)
             if p is None: raise NotFound()
-            return jsonify(p.status), 201 if p.pronto else 202
+            cursor, linhas = p.status_desde(request.args.get("since", default = 0, type = int))
+            resposta = jsonify(status = linhas, proximo = cursor, posicao = biblioteca.posicao_na_fila(p), prontos = p.prontos, tempos = p.resumo_tempos)
+            if p.falha is not None: return resposta, 500
+            return resposta, 201 if p.pronto else 202
+
+        @app.get("/<arq>/eventos")
+        def eventos(arq: str) -> Response:
+            p = biblioteca.localizar_pacote(arq)
+            if p is None: raise NotFound()
+            cursor = request.headers.get("Last-Event-ID", default = request.args.get("since", default = 0, type = int), type = int)
+            headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            return Response(stream_with_context(transmitir_eventos(biblioteca, p, cursor)), mimetype = "text/event-stream", headers = headers)
 
         @app.get("/<arq>")
-        def download(arq: str) -> tuple[Response, int]:
+        def download(arq: str) -> Response:
+            p = biblioteca.localizar_pacote(arq)
+            if p is None or p.falha is not None or not p.out_file.exists: raise NotFound()
+            pronto = p.pronto
+            if pronto is not None: return enviar_zip(p.out_file, pronto)
+            headers = {"Content-Disposition": f"attachment; filename={p.out_file.local_name}", "Cache-Control": "no-store"}
+            return Response(stream_with_context(transmitir_zip(p)), mimetype = "application/zip", headers = headers)
+
+        @app.get("/<arq>/<livro>.pdf")
+        def download_livro(arq: str, livro: str) -> Response:
             p = biblioteca.localizar_pacote(arq)
             if p is None: raise NotFound()
-            t = send_file(p.out_file.absolute_name)
-            return t, 200
+            pronto = p.pronto
+            caminho = p.caminho_livro(f"{livro}.pdf")
+            if caminho is None: raise NotFound()
+            if pronto is None or p.falha is not None:
+                return send_file(caminho, mimetype = "application/pdf", download_name = f"{livro}.pdf", etag = False)
+            # Depois de pronto, o PDF é extraído do ZIP, e o ETag é derivado do ETag do ZIP.
+            etag = f"{etag_arquivo(p.out_file.absolute_name)}-{hashlib.sha256(livro.encode('utf-8')).hexdigest()[:16]}"
+            t = send_file(caminho, mimetype = "application/pdf", download_name = f"{livro}.pdf", etag = etag, conditional = True)
+            return armazenar_ate_expirar(t, pronto)
 
     def start(self) -> None:
         def run() -> None:
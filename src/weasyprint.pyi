@@ -1,9 +1,10 @@
-from typing import Any, Sequence
+from email.message import Message
+from typing import IO, Any, Sequence
 
 Tree = tuple[str, tuple[int, float, float], Sequence[Any], Any]
 
 class Page:
-    pass
+    anchors: dict[str, tuple[float, float]]
 
 class Document:
     def write_pdf(self, s: str) -> None: ...
@@ -14,6 +15,20 @@ class Document:
     def make_bookmark_tree(self) -> Sequence[Tree]: ...
 
 class Html:
-    def render(self) -> Document: ...
+    def render(self, font_config: Any = None, cache: dict[str, Any] | None = None) -> Document: ...
 
-def HTML(string: str) -> Html: ...
\ No newline at end of file
+class URLFetcherResponse:
+    url: str
+    status: Any
+    headers: Message
+
+    def __init__(self, url: str, body: bytes | IO[bytes] | None = None, headers: dict[str, str] | Message | None = None, status: Any = ...) -> None: ...
+
+    def read(self) -> bytes: ...
+
+    def close(self) -> None: ...
+
+class URLFetcher:
+    def fetch(self, url: str, headers: dict[str, str] | None = None) -> URLFetcherResponse: ...
+
+def HTML(string: str, url_fetcher: URLFetcher = ...) -> Html: ...
\ No newline at end of file